@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmark how long ci.py takes to start up and find the repo's CI webpages, as
+it's meant to feel instant when aliased to `ci`.
+
+Runs `ci.py --dry-run` in a fresh interpreter each time, and compares with an
+interpreter doing nothing.
+
+# Example
+
+$ bench-ci.py --runs 20 --target-ms 50
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+CI = Path(__file__).parent / "ci.py"
+
+
+def time_runs(command, runs, cwd):
+    """Wall-clock milliseconds for each run of a command"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, check=False)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--runs", type=int, default=20, help="Runs of each command")
+    parser.add_argument(
+        "--repo", default=".", help="Run ci.py in this Git checkout, with an origin"
+    )
+    parser.add_argument(
+        "--target-ms",
+        type=float,
+        help="Exit with an error if the median run of ci.py is slower than this",
+    )
+    args = parser.parse_args()
+
+    baseline = time_runs([sys.executable, "-c", "pass"], args.runs, args.repo)
+    ci = time_runs([sys.executable, str(CI), "--dry-run"], args.runs, args.repo)
+
+    print(f"{'Command':<12} {'Min ms':>8} {'Median ms':>10} {'Max ms':>8}")
+    for name, times in (("python", baseline), ("ci.py", ci)):
+        print(
+            f"{name:<12} {min(times):8.1f} {statistics.median(times):10.1f} "
+            f"{max(times):8.1f}"
+        )
+    overhead = statistics.median(ci) - statistics.median(baseline)
+    print(f"ci.py takes {overhead:.1f} ms more than starting Python")
+
+    if args.target_ms is not None and statistics.median(ci) > args.target_ms:
+        sys.exit(f"Slower than the {args.target_ms:g} ms target")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Benchmark the travis-sorter scheduling engine: how fast each strategy is, how much
+memory it needs, and how close its makespan gets to the lower bound.
+
+Job lengths come from synthetic distributions, and the results are written as JSON
+so runs from different commits can be compared.
+
+# Example
+
+$ bench-travis-sorter.py --sizes 10,100,1000 --limits 1,5,64 -o before.json
+$ git switch my-branch
+$ bench-travis-sorter.py --sizes 10,100,1000 --limits 1,5,64 -o after.json \
+    --compare before.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+from travis_scheduler import Job, lower_bound, order_jobs, simulate
+
+
+def uniform(rng, n):
+    return [rng.uniform(1, 60) for _ in range(n)]
+
+
+def long_tail(rng, n):
+    # Mostly a few minutes, with the odd job taking hours
+    return [rng.lognormvariate(2, 1) for _ in range(n)]
+
+
+def bimodal(rng, n):
+    # Lots of quick jobs and some slow ones, like unit and integration tests
+    return [
+        max(0.1, rng.gauss(40, 5) if rng.random() < 0.2 else rng.gauss(5, 1))
+        for _ in range(n)
+    ]
+
+
+DISTRIBUTIONS = {"uniform": uniform, "long-tail": long_tail, "bimodal": bimodal}
+STRATEGIES = ("current", "lpt", "multifit", "exact")
+
+
+def run_strategy(jobs, limit, strategy, budget):
+    """Order and simulate the jobs, returning the makespan"""
+    if strategy != "current":
+        jobs, _ = order_jobs(jobs, limit, strategy, budget)
+    return simulate(jobs, limit).makespan
+
+
+def bench(distribution, n, limit, strategy, budget, seed):
+    rng = random.Random(f"{seed}-{distribution}-{n}")
+    lengths = DISTRIBUTIONS[distribution](rng, n)
+    jobs = [Job(length, id=i) for i, length in enumerate(lengths, start=1)]
+
+    start = time.perf_counter()
+    makespan = run_strategy(jobs, limit, strategy, budget)
+    seconds = time.perf_counter() - start
+
+    # Run again to measure memory, as tracing slows everything down
+    tracemalloc.start()
+    run_strategy(jobs, limit, strategy, budget)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    bound = lower_bound(lengths, limit)
+    return {
+        "distribution": distribution,
+        "jobs": n,
+        "limit": limit,
+        "strategy": strategy,
+        "seconds": seconds,
+        "peak_bytes": peak,
+        "makespan": makespan,
+        "lower_bound": bound,
+        "gap": (makespan - bound) / bound if bound else 0,
+    }
+
+
+def key(result):
+    return (
+        result["distribution"],
+        result["jobs"],
+        result["limit"],
+        result["strategy"],
+    )
+
+
+def compare(results, filename):
+    """Show how much slower or worse each result is than in an older run"""
+    with open(filename) as f:
+        old = {key(result): result for result in json.load(f)["results"]}
+
+    print()
+    print(f"Compared with {filename}:")
+    print(f"{'Distribution':<12} {'Jobs':>6} {'Limit':>5} {'Strategy':<8} Time   Gap")
+    for result in results:
+        before = old.get(key(result))
+        if not before:
+            continue
+        speed = result["seconds"] / before["seconds"] if before["seconds"] else 1
+        gap = result["gap"] - before["gap"]
+        print(
+            f"{result['distribution']:<12} {result['jobs']:6d} {result['limit']:5d} "
+            f"{result['strategy']:<8} {speed:5.2f}x {gap:+.2%}"
+        )
+
+
+def get_commit():
+    exitcode, output = subprocess.getstatusoutput("git rev-parse HEAD")
+    return output if exitcode == 0 else None
+
+
+def ints(value):
+    return [int(x) for x in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--sizes",
+        type=ints,
+        default="10,100,1000,10000",
+        help="Comma-separated numbers of jobs, up to 100000",
+    )
+    parser.add_argument(
+        "--limits",
+        type=ints,
+        default="1,4,16,64,256",
+        help="Comma-separated concurrent jobs limits",
+    )
+    parser.add_argument(
+        "--distributions",
+        type=lambda value: value.split(","),
+        default=",".join(DISTRIBUTIONS),
+        help="Comma-separated job length distributions",
+    )
+    parser.add_argument(
+        "--strategies",
+        type=lambda value: value.split(","),
+        default=",".join(STRATEGIES),
+        help="Comma-separated strategies, current is the unsorted order",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1,
+        help="Time limit in seconds for the exact strategy",
+    )
+    parser.add_argument(
+        "--exact-max-jobs",
+        type=int,
+        default=100,
+        help="Skip the exact strategy for more jobs than this",
+    )
+    parser.add_argument("--seed", default="0", help="Random seed for job lengths")
+    parser.add_argument(
+        "-o", "--output", default="bench.json", help="Write results to this file"
+    )
+    parser.add_argument("--compare", help="Compare with results from an older run")
+    args = parser.parse_args()
+
+    results = []
+    print(
+        f"{'Distribution':<12} {'Jobs':>6} {'Limit':>5} {'Strategy':<8} "
+        f"{'Seconds':>8} {'Peak KiB':>9} {'Gap':>7}"
+    )
+    for distribution in args.distributions:
+        for n in args.sizes:
+            for limit in args.limits:
+                for strategy in args.strategies:
+                    if strategy == "exact" and n > args.exact_max_jobs:
+                        continue
+                    result = bench(
+                        distribution, n, limit, strategy, args.budget, args.seed
+                    )
+                    results.append(result)
+                    print(
+                        f"{distribution:<12} {n:6d} {limit:5d} {strategy:<8} "
+                        f"{result['seconds']:8.4f} "
+                        f"{result['peak_bytes'] / 1024:9.1f} {result['gap']:7.2%}"
+                    )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "commit": get_commit(),
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+        f.write("\n")
+    print()
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
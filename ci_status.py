@@ -0,0 +1,270 @@
+"""
+The state of the latest CI run from each provider's API, for ci.py --status.
+
+Requests to each host share a few keep-alive connections, and responses are cached
+for a short time, so checking again straight away is instant.
+
+Set GITHUB_TOKEN, GITLAB_TOKEN, APPVEYOR_TOKEN or TRAVIS_TOKEN for private repos or
+higher rate limits. Point GITHUB_API_URL, GITLAB_API_URL, APPVEYOR_API_URL or
+TRAVIS_API_URL somewhere else to use another server, such as a local stub.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import http.client
+import importlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "ci-tools"
+    / "status"
+)
+DEFAULT_MAX_AGE = 60
+DEFAULT_TIMEOUT = 10
+
+
+class APIError(Exception):
+    pass
+
+
+class HTTPPool:
+    """Keep-alive connections shared between threads, up to a few idle per host"""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT, max_idle: int = 4) -> None:
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+        self.lock = threading.Lock()
+
+    def _connect(self, scheme: str, host: str) -> http.client.HTTPConnection:
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def _release(
+        self, scheme: str, host: str, connection: http.client.HTTPConnection
+    ) -> None:
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def get(self, url: str, headers: dict[str, str]) -> bytes:
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        key = parts.scheme, parts.netloc
+        with self.lock:
+            idle = self.idle.get(key)
+            connection = idle.pop() if idle else None
+
+        # The server may have closed an idle connection, so try a new one too
+        for reused in (True, False) if connection else (False,):
+            if not reused:
+                connection = self._connect(*key)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(*key, connection)
+        if response.status >= 400:
+            msg = f"HTTP {response.status} from {url}"
+            raise APIError(msg)
+        return body
+
+
+class Client:
+    """Get JSON from provider APIs, cached for `max_age` seconds"""
+
+    def __init__(
+        self, max_age: float = DEFAULT_MAX_AGE, timeout: float = DEFAULT_TIMEOUT
+    ) -> None:
+        self.max_age = max_age
+        self.pool = HTTPPool(timeout)
+
+    def get_json(self, url: str, headers: dict[str, str] | None = None):
+        path = CACHE_DIR / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+        try:
+            if time.time() - path.stat().st_mtime < self.max_age:
+                return json.loads(path.read_bytes())
+        except (OSError, ValueError):
+            pass
+
+        body = self.pool.get(
+            url,
+            {"Accept": "application/json", "User-Agent": "ci-tools", **(headers or {})},
+        )
+        data = json.loads(body)
+        # Write somewhere else first, so other processes never see half a file
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=CACHE_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(temp, path)
+        return data
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    # fromisoformat() before Python 3.11 needs +00:00 rather than Z, and at most
+    # six decimal places, where AppVeyor gives seven
+    timestamp = re.sub(r"(\.\d{6})\d+", r"\1", timestamp.replace("Z", "+00:00"))
+    return datetime.fromisoformat(timestamp)
+
+
+def seconds_between(start: str | None, finish: str | None) -> float | None:
+    if not start or not finish:
+        return None
+    return (parse_timestamp(finish) - parse_timestamp(start)).total_seconds()
+
+
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "-"
+    m, s = divmod(round(seconds), 60)
+    return f"{m:02}m{s:02}s"
+
+
+def token_header(name: str, variable: str, prefix: str = "") -> dict[str, str]:
+    token = os.environ.get(variable)
+    return {name: prefix + token} if token else {}
+
+
+def github_status(client: Client, origin_url: str, user: str, repo: str) -> dict:
+    parts = urllib.parse.urlsplit(origin_url)
+    # GitHub Enterprise serves its API under the same host
+    default = (
+        "https://api.github.com"
+        if parts.netloc == "github.com"
+        else f"{parts.scheme}://{parts.netloc}/api/v3"
+    )
+    api = os.environ.get("GITHUB_API_URL", default)
+    runs = client.get_json(
+        f"{api}/repos/{user}/{repo}/actions/runs?per_page=1",
+        token_header("Authorization", "GITHUB_TOKEN", "Bearer "),
+    )["workflow_runs"]
+    if not runs:
+        return {"state": "none", "duration": None}
+    run = runs[0]
+    finished = run["status"] == "completed"
+    return {
+        "state": run["conclusion"] if finished else run["status"],
+        "duration": (
+            seconds_between(run.get("run_started_at"), run.get("updated_at"))
+            if finished
+            else None
+        ),
+    }
+
+
+def gitlab_status(client: Client, origin_url: str, user: str, repo: str) -> dict:
+    parts = urllib.parse.urlsplit(origin_url)
+    api = os.environ.get("GITLAB_API_URL", f"{parts.scheme}://{parts.netloc}/api/v4")
+    project = urllib.parse.quote(parts.path.strip("/"), safe="")
+    headers = token_header("PRIVATE-TOKEN", "GITLAB_TOKEN")
+    pipelines = client.get_json(
+        f"{api}/projects/{project}/pipelines?per_page=1", headers
+    )
+    if not pipelines:
+        return {"state": "none", "duration": None}
+    # Only the full pipeline has its duration
+    pipeline = client.get_json(
+        f"{api}/projects/{project}/pipelines/{pipelines[0]['id']}", headers
+    )
+    return {"state": pipeline["status"], "duration": pipeline.get("duration")}
+
+
+def appveyor_status(client: Client, origin_url: str, user: str, repo: str) -> dict:
+    api = os.environ.get("APPVEYOR_API_URL", "https://ci.appveyor.com/api")
+    build = client.get_json(
+        f"{api}/projects/{user}/{repo}",
+        token_header("Authorization", "APPVEYOR_TOKEN", "Bearer "),
+    ).get("build")
+    if not build:
+        return {"state": "none", "duration": None}
+    return {
+        "state": build["status"],
+        "duration": seconds_between(build.get("started"), build.get("finished")),
+    }
+
+
+def travis_status(client: Client, origin_url: str, user: str, repo: str) -> dict:
+    api = os.environ.get("TRAVIS_API_URL", "https://api.travis-ci.com")
+    slug = urllib.parse.quote(f"{user}/{repo}", safe="")
+    builds = client.get_json(
+        f"{api}/repo/{slug}/builds?limit=1",
+        {
+            "Travis-API-Version": "3",
+            **token_header("Authorization", "TRAVIS_TOKEN", "token "),
+        },
+    )["builds"]
+    if not builds:
+        return {"state": "none", "duration": None}
+    build = builds[0]
+    return {
+        "state": build["state"],
+        "duration": seconds_between(build.get("started_at"), build.get("finished_at")),
+    }
+
+
+def load_status_function(spec: str):
+    """Import a function from "module:function", such as ci_status:github_status"""
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def get_status(client: Client, spec: str | None, origin_url: str) -> dict:
+    """The latest run's state and duration in seconds, or the error getting it.
+    `spec` is the provider's "module:function" taking (client, origin_url, user,
+    repo), or None if it has no API to ask"""
+    if spec is None:
+        return {"state": "unknown", "duration": None}
+    user, repo = origin_url.rstrip("/").split("/")[-2:]
+    try:
+        return load_status_function(spec)(client, origin_url, user, repo)
+    except (
+        OSError,
+        http.client.HTTPException,
+        APIError,
+        ImportError,
+        AttributeError,
+        KeyError,
+        ValueError,
+    ) as e:
+        return {"state": f"error: {e}", "duration": None}
+
+
+def get_statuses(
+    targets: list[tuple[str, str]],
+    max_age: float = DEFAULT_MAX_AGE,
+    timeout: float = DEFAULT_TIMEOUT,
+    workers: int = 16,
+) -> list[dict]:
+    """Statuses for (status function spec, origin URL) pairs, all fetched at the
+    same time"""
+    client = Client(max_age, timeout)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda target: get_status(client, *target), targets))
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+Diff the logs of two Travis CI jobs, ignoring what changes every run: timestamps,
+durations, temporary paths, hashes and terminal escapes.
+
+Logs are read from the local log store shared with grep-travis-logs.py, and only
+downloaded on a miss. While diffing, each line is just a hash in an array, and
+the lines matching up the two logs are found by sorting, with the results kept
+in arrays too. Memory is around a hundred bytes per line at its peak, such as
+about 100 MB for two logs of a million lines each, and the text is only read
+again to print the hunks.
+
+With --timing, compare how long each section of the logs took instead, matching up
+the travis_fold and travis_time sections of the two jobs, or of each job of two
+builds, and showing the biggest slowdowns first.
+
+For example:
+
+$ diff-travis-logs.py 361337420 368529735
+$ diff-travis-logs.py --timing --format json 361337420 368529735
+$ diff-travis-logs.py --timing https://app.travis-ci.com/github/python-pillow/Pillow/builds/1 \
+    https://app.travis-ci.com/github/python-pillow/Pillow/builds/2
+$ diff-travis-logs.py https://app.travis-ci.com/github/python-pillow/docker-images/jobs/361337420 \
+    https://app.travis-ci.com/github/python-pillow/docker-images/jobs/368529735
+"""  # noqa: E501
+
+from __future__ import annotations
+
+import argparse
+import difflib
+import json
+import re
+import shutil
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, zip_longest
+
+from travis_log_steps import ANSI, format_seconds, parse_steps
+from travis_log_store import (
+    DEFAULT_API,
+    DEFAULT_MAX_BYTES,
+    LogStore,
+    get_json,
+    open_log,
+)
+
+# Above this many lines times lines, don't look for the best diff of a region with
+# no unique lines in common, just replace it
+MAX_QUADRATIC = 1_000_000
+# Line indices are packed into the low 32 bits of ints for sorting
+INDEX_MASK = (1 << 32) - 1
+
+# Text which changes from run to run, and what to replace it with
+VOLATILE = {
+    # Keep the fold and timer names but not their IDs and times
+    "marker": r"(?P<kind>travis_(?:fold|time):(?:start|end)):[^\s\x1b]*",
+    "time": (
+        r"\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?(?:Z|[+-]\d\d:?\d\d)?"
+        r"|\b\d\d:\d\d:\d\d(?:[.,]\d+)?\b"
+    ),
+    "duration": (
+        r"\b\d+(?:\.\d+)?\s?(?:ms|s|secs?|seconds?|mins?|minutes?|h|hrs?|hours?)\b"
+        r"|\b\d+m\d+(?:\.\d+)?s\b"
+    ),
+    "tmp": (
+        r"/(?:tmp|var/folders|private/var/folders)/[^\s'\":]+"
+        r"|(?i:[A-Z]:\\Users\\[^\\\s]+\\AppData\\Local\\Temp\\\S+)"
+    ),
+    "addr": r"\b0x[0-9a-fA-F]+\b",
+    "hash": r"\b(?=[0-9a-f]*[a-f])(?=[0-9a-f]*\d)[0-9a-f]{7,64}\b",
+}
+# One pass over each line for all of them
+VOLATILE_RE = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in VOLATILE.items())
+)
+
+
+def replace_volatile(match):
+    if match.lastgroup == "marker":
+        return match.group("kind")
+    return f"<{match.lastgroup.upper()}>"
+
+
+def normalize(line):
+    """A line with what changes from run to run replaced by placeholders"""
+    line = ANSI.sub("", line.rstrip("\r\n"))
+    # Progress bars redraw the line, only the last one shows
+    line = line.rsplit("\r", 1)[-1]
+    return VOLATILE_RE.sub(replace_volatile, line)
+
+
+def hash_lines(f, normalized=True):
+    """A hash of each line, so a log can be diffed without keeping its text"""
+    hashes = array("q")
+    for line in f:
+        hashes.append(hash(normalize(line) if normalized else line))
+    return hashes
+
+
+def unique(hashes, lo, hi):
+    """The lines appearing once in hashes[lo:hi], as an array of their hashes,
+    sorted, and an array of their indices"""
+    # Each hash and index packed into one int, so sorting needs no tuples
+    keys = sorted((hashes[i] << 32) | i for i in range(lo, hi))
+    once = array("q")
+    indices = array("q")
+    previous = None
+    for k, key in enumerate(keys):
+        h = key >> 32
+        if h != previous and (k + 1 == len(keys) or keys[k + 1] >> 32 != h):
+            once.append(h)
+            indices.append(key & INDEX_MASK)
+        previous = h
+    return once, indices
+
+
+def common_unique(a, alo, ahi, b, blo, bhi):
+    """The lines unique to each region and in both, as an array of indices into
+    a, increasing, and an array of the matching indices into b"""
+    once_a, indices_a = unique(a, alo, ahi)
+    once_b, indices_b = unique(b, blo, bhi)
+    # Both are sorted by hash, so walk them together
+    pairs = []
+    k = 0
+    for h, j in zip(once_b, indices_b):
+        while k < len(once_a) and once_a[k] < h:
+            k += 1
+        if k < len(once_a) and once_a[k] == h:
+            pairs.append((indices_a[k] << 32) | j)
+    del once_a, indices_a, once_b, indices_b
+    pairs.sort()
+    return (
+        array("q", (pair >> 32 for pair in pairs)),
+        array("q", (pair & INDEX_MASK for pair in pairs)),
+    )
+
+
+def longest_increasing(indices_a, indices_b):
+    """The longest run of pairs of indices, in order of indices_a, with those in
+    indices_b increasing too, as two arrays. Each pair links back to the one
+    before it by its position, so only arrays are kept."""
+    tails = array("q")
+    tail_positions = array("q")
+    previous = array("q", bytes(8 * len(indices_b)))
+    for position, j in enumerate(indices_b):
+        k = bisect_left(tails, j)
+        previous[position] = tail_positions[k - 1] if k else -1
+        if k == len(tails):
+            tails.append(j)
+            tail_positions.append(position)
+        else:
+            tails[k] = j
+            tail_positions[k] = position
+    del tails
+    run_a = array("q")
+    run_b = array("q")
+    position = tail_positions[-1] if tail_positions else -1
+    while position >= 0:
+        run_a.append(indices_a[position])
+        run_b.append(indices_b[position])
+        position = previous[position]
+    run_a.reverse()
+    run_b.reverse()
+    return run_a, run_b
+
+
+def patience_opcodes(a, b):
+    """Like difflib.SequenceMatcher.get_opcodes(), using patience diff: lines
+    unique to both sides anchor the diff, and the regions between anchors are
+    diffed the same way"""
+    opcodes = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        # Common prefix and suffix
+        start_a, start_b = alo, blo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start_a:
+            opcodes.append(("equal", start_a, alo, start_b, blo))
+        end_a, end_b = ahi, bhi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if ahi < end_a:
+            opcodes.append(("equal", ahi, end_a, bhi, end_b))
+
+        if alo == ahi or blo == bhi:
+            if alo < ahi:
+                opcodes.append(("delete", alo, ahi, blo, bhi))
+            elif blo < bhi:
+                opcodes.append(("insert", alo, ahi, blo, bhi))
+            continue
+
+        anchors_a, anchors_b = longest_increasing(
+            *common_unique(a, alo, ahi, b, blo, bhi)
+        )
+        if anchors_a:
+            # Regions between the anchors, each anchor then being a prefix. A
+            # run of neighbouring anchors is all prefix of the region starting
+            # at its first, so needs no regions of its own.
+            i1, j1 = alo, blo
+            last_a = last_b = -2
+            for i2, j2 in zip(anchors_a, anchors_b):
+                if i2 != last_a + 1 or j2 != last_b + 1:
+                    stack.append((i1, i2, j1, j2))
+                    i1, j1 = i2, j2
+                last_a, last_b = i2, j2
+            stack.append((i1, ahi, j1, bhi))
+        elif (ahi - alo) * (bhi - blo) <= MAX_QUADRATIC:
+            matcher = difflib.SequenceMatcher(
+                None, a[alo:ahi], b[blo:bhi], autojunk=False
+            )
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                opcodes.append((tag, alo + i1, alo + i2, blo + j1, blo + j2))
+        else:
+            opcodes.append(("replace", alo, ahi, blo, bhi))
+    # Merge neighbours with the same tag
+    merged = []
+    for opcode in sorted(opcodes, key=lambda opcode: (opcode[1], opcode[3])):
+        if opcode[1] == opcode[2] and opcode[3] == opcode[4]:
+            continue
+        if merged and merged[-1][0] == opcode[0] == "equal":
+            merged[-1] = ("equal", merged[-1][1], opcode[2], merged[-1][3], opcode[4])
+        else:
+            merged.append(opcode)
+    return merged
+
+
+def group_opcodes(opcodes, n=3):
+    """Like difflib.SequenceMatcher.get_grouped_opcodes(): hunks of changes with
+    up to `n` lines of context"""
+    if not opcodes:
+        return
+    opcodes = list(opcodes)
+    if opcodes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[0]
+        opcodes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if opcodes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = opcodes[-1]
+        opcodes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        # A long stretch of equal lines ends a hunk
+        if tag == "equal" and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+class LineReader:
+    """Read lines forwards from a file, by index"""
+
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+
+    def lines(self, start, stop):
+        """Lines `start` to `stop`, which can't be before those already read"""
+        lines = list(islice(self.f, start - self.position, stop - self.position))
+        self.position = stop
+        return lines
+
+
+def hunk_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        start -= 1
+    return f"{start + 1},{length}"
+
+
+def unified_diff(a, b, name_a, name_b, n=3, normalized=True):
+    """Yield a unified diff of two files, which are read twice: once to hash the
+    lines and once to print the hunks"""
+    with a() as f:
+        hashes_a = hash_lines(f, normalized)
+    with b() as f:
+        hashes_b = hash_lines(f, normalized)
+
+    groups = group_opcodes(patience_opcodes(hashes_a, hashes_b), n)
+    with a() as fa, b() as fb:
+        reader_a, reader_b = LineReader(fa), LineReader(fb)
+        started = False
+        for group in groups:
+            if not started:
+                yield f"--- {name_a}\n"
+                yield f"+++ {name_b}\n"
+                started = True
+            first, last = group[0], group[-1]
+            yield (
+                f"@@ -{hunk_range(first[1], last[2])} "
+                f"+{hunk_range(first[3], last[4])} @@\n"
+            )
+            for tag, i1, i2, j1, j2 in group:
+                # Hunks come in order, so each file is only read forwards
+                lines_a = reader_a.lines(i1, i2)
+                lines_b = reader_b.lines(j1, j2)
+                if tag == "equal":
+                    for line in lines_a:
+                        yield " " + ensure_newline(line)
+                    continue
+                for line in lines_a:
+                    yield "-" + ensure_newline(line)
+                for line in lines_b:
+                    yield "+" + ensure_newline(line)
+
+
+def ensure_newline(line):
+    return line if line.endswith("\n") else line + "\n"
+
+
+def job_id(value):
+    """A job ID from an ID or a job URL"""
+    return value.rstrip("/").rsplit("/", 1)[-1]
+
+
+def is_build(value):
+    return "/builds/" in value
+
+
+def build_job_ids(build, api):
+    """IDs of the jobs in a build, in job number order"""
+    jobs = get_json(f"{api}/v3/build/{build}")["jobs"]
+    return sorted(job["id"] for job in jobs)
+
+
+def job_steps(store, job, api):
+    with open_log(store, job, api=api) as f:
+        return parse_steps(f)
+
+
+def section_key(step):
+    """Sections match when they have the same name and the same command, after
+    normalizing"""
+    return step.name, normalize(step.command or "")
+
+
+def align_sections(before, after):
+    """Pairs of matching steps from two jobs, in order, with None for a step only
+    in one of them"""
+    matcher = difflib.SequenceMatcher(
+        None,
+        [section_key(step) for step in before],
+        [section_key(step) for step in after],
+        autojunk=False,
+    )
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            yield from zip(before[i1:i2], after[j1:j2])
+        else:
+            for step in before[i1:i2]:
+                yield step, None
+            for step in after[j1:j2]:
+                yield None, step
+
+
+def timing_rows(pairs, job=None):
+    rows = []
+    for old, new in pairs:
+        step = old or new
+        section = step.name
+        if step.command and step.command != step.name:
+            section += f": {step.command}"
+        before = old.duration if old else 0
+        after = new.duration if new else 0
+        rows.append(
+            {
+                "job": job,
+                "section": section,
+                "before": before if old else None,
+                "after": after if new else None,
+                "delta": after - before,
+            }
+        )
+    return rows
+
+
+def timing_diff(store, old, new, api, workers=8):
+    """A row for each section of two jobs, or of each pair of jobs of two builds,
+    with how much longer it took, biggest slowdown first"""
+    if is_build(old) or is_build(new):
+        old_jobs = build_job_ids(job_id(old), api)
+        new_jobs = build_job_ids(job_id(new), api)
+    else:
+        old_jobs, new_jobs = [job_id(old)], [job_id(new)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        old_steps = list(executor.map(lambda job: job_steps(store, job, api), old_jobs))
+        new_steps = list(executor.map(lambda job: job_steps(store, job, api), new_jobs))
+
+    rows = []
+    # Match up jobs by their position in each build
+    for i, (before, after) in enumerate(
+        zip_longest(old_steps, new_steps, fillvalue=[]), start=1
+    ):
+        job = i if len(old_jobs) > 1 or len(new_jobs) > 1 else None
+        rows += timing_rows(align_sections(before, after), job)
+    rows.sort(key=lambda row: -row["delta"])
+    return rows
+
+
+def format_delta(seconds):
+    sign = "-" if seconds < 0 else "+"
+    return sign + format_seconds(abs(seconds))
+
+
+def print_timing(rows, output_format):
+    if output_format == "json":
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'Delta':<8} {'Before':<7} {'After':<7} {'Job':>3}  Section")
+    for row in rows:
+        before = "-" if row["before"] is None else format_seconds(row["before"])
+        after = "-" if row["after"] is None else format_seconds(row["after"])
+        job = "" if row["job"] is None else row["job"]
+        print(
+            f"{format_delta(row['delta']):<8} {before:<7} {after:<7} {job:>3}  "
+            f"{row['section']}"
+        )
+    total = sum(row["delta"] for row in rows)
+    print(f"{format_delta(total):<8} {'':<7} {'':<7} {'':>3}  Total")
+
+
+def log_opener(store, job, api):
+    """A function opening the job's log, which can be called more than once.
+    Logs not kept in the store are spooled to a temporary file first."""
+    f = open_log(store, job, api=api)
+    if store is not None and store.path(job) is not None:
+        f.close()
+        return lambda: store.open(job)
+
+    spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+    with f:
+        shutil.copyfileobj(f, spool)
+
+    def reopen():
+        spool.seek(0)
+        # Don't let the caller close it
+        return open(spool.fileno(), encoding="utf-8", closefd=False)
+
+    return reopen
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("job1", help="Travis CI job ID or URL, or build URL")
+    parser.add_argument("job2", help="Travis CI job ID or URL, or build URL")
+    parser.add_argument(
+        "-U",
+        "--unified",
+        type=int,
+        default=3,
+        help="Lines of context around each change",
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Diff the logs as they are, without normalizing volatile text",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Compare how long each section took instead, for jobs or builds",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("table", "json"),
+        default="table",
+        help="Output format for --timing",
+    )
+    parser.add_argument("--api", default=DEFAULT_API, help="Travis CI API URL")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write logs in the local log store",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=DEFAULT_MAX_BYTES // 1024 // 1024,
+        help="Size limit for the local log store, in MiB",
+    )
+    args = parser.parse_args()
+
+    store = (
+        None
+        if args.no_cache
+        else LogStore(max_bytes=args.cache_mb * 1024 * 1024, api=args.api)
+    )
+    if args.timing:
+        print_timing(timing_diff(store, args.job1, args.job2, args.api), args.format)
+        sys.exit()
+    if is_build(args.job1) or is_build(args.job2):
+        parser.error("only --timing can compare builds")
+
+    job1, job2 = job_id(args.job1), job_id(args.job2)
+    diff = unified_diff(
+        log_opener(store, job1, args.api),
+        log_opener(store, job2, args.api),
+        job1,
+        job2,
+        args.unified,
+        not args.raw,
+    )
+    different = False
+    for line in diff:
+        sys.stdout.write(line)
+        different = True
+    # Like diff
+    sys.exit(1 if different else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,27 +3,324 @@
 
 For example: python grep-travis-logs.py -p "tests in" -n 3928
 For example: python grep-travis-logs.py -p "tests in" -n 3928.2
+For example: python grep-travis-logs.py -p "tests in" -n 3900-3928
+For example: python grep-travis-logs.py -p "tests in" -n 3910,3915.2
+For example: python grep-travis-logs.py -p "tests in" --since 3900
 """
 
 from __future__ import annotations
 
 import argparse
+import collections
+import itertools
+import queue
 import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from travis_history import BuildHistory
+from travis_log_index import LogIndex
+from travis_log_steps import (
+    add_totals,
+    format_seconds,
+    parse_steps,
+    print_totals,
+    total_by_step,
+)
+from travis_log_store import (
+    DEFAULT_API,
+    DEFAULT_MAX_BYTES,
+    FINISHED_STATES,
+    LogStore,
+    open_log,
+    session,
+    stream,
+)
 
 
 def split_build_number(number):
-    """Split a float into build int and job int:
+    """Split a build number into build int and job int:
     Given 3928.2, return 3829 and 2
     Given 3928, return 3829 and None
     """
     # Use string to avoid 4393.2 -> 4393, 1 due to floating-point arithmetic
-    build, job = str(number).split(".")
-    build, job = int(build), int(job)
+    build, _, job = str(number).partition(".")
+    build, job = int(build), int(job or 0)
     if job == 0:
         job = None
     return build, job
 
 
+def parse_numbers(value):
+    """Parse build numbers into a dict of build int to a set of job numbers, or None
+    for all jobs:
+    Given 3928.2, return {3928: {"3928.2"}}
+    Given 3900-3902, return {3900: None, 3901: None, 3902: None}
+    Given 3910,3915.2, return {3910: None, 3915: {"3915.2"}}
+    """
+    selected = {}
+    for part in value.split(","):
+        first, dash, last = part.partition("-")
+        if dash:
+            for build in range(int(first), int(last) + 1):
+                selected[build] = None
+            continue
+        build, job = split_build_number(part)
+        if job is None:
+            selected[build] = None
+        elif selected.get(build, set()) is not None:
+            selected.setdefault(build, set()).add(f"{build}.{job}")
+    return selected
+
+
+def share_session(t, workers):
+    """Let all the threads reuse one pool of connections in the client's session,
+    and another in the session fetching logs"""
+    from requests.adapters import HTTPAdapter
+
+    for shared in (getattr(t, "_session", None), session()):
+        if shared is not None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+            shared.mount("https://", adapter)
+            shared.mount("http://", adapter)
+
+
+def fetch_builds(t, slug, numbers, workers):
+    """Fetch builds concurrently, yielding them in order and skipping missing ones"""
+
+    def fetch(number):
+        builds = t.builds(slug=slug, number=number)
+        return builds[0] if builds else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for build in executor.map(fetch, numbers):
+            if build is not None:
+                yield build
+
+
+def fetch_job_log(t, job_id, numbers, store, follow=False, job=None, api=DEFAULT_API):
+    """Fetch a job and open its log, or None if job numbers are given and it's not
+    one of them. Finished logs come from the store if there, and are streamed into
+    it if not. When following, running jobs' logs are left for follow_log().
+
+    `job` is the job if already known, such as from the local build history.
+    """
+    if job is None:
+        job = t.job(job_id)
+    if numbers and job.number not in numbers:
+        return None
+    finished = job.state in FINISHED_STATES
+    if follow and not finished:
+        return job, None
+    return job, open_log(store, job_id, finished, api)
+
+
+def fetch_from(url, offset):
+    """The bytes of a URL from `offset` on, asking the server for just those"""
+    import requests
+
+    try:
+        # Offsets count bytes of the log itself, not of a compressed copy
+        headers = {"Range": f"bytes={offset}-", "Accept-Encoding": "identity"}
+        with stream(url, headers) as response:
+            data = response.raw.read()
+            if response.status_code == 206:
+                return data
+            # The server ignored the range and sent everything
+            return data[offset:]
+    except requests.HTTPError as e:
+        if e.response.status_code == 416:
+            # Nothing new yet
+            return b""
+        raise
+
+
+def follow_log(t, job_id, interval, api=DEFAULT_API):
+    """Yield new lines of a running job's log as they arrive, until it finishes.
+    Only the bytes after those already seen are fetched each time."""
+    url = f"{api}/v3/job/{job_id}/log.txt"
+    offset = 0
+    partial = b""
+    while True:
+        # Check first, so the last fetch gets everything up to the end
+        finished = t.job(job_id).state in FINISHED_STATES
+        data = fetch_from(url, offset)
+        offset += len(data)
+        *lines, partial = (partial + data).split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8", errors="replace") + "\n"
+        if finished:
+            if partial:
+                yield partial.decode("utf-8", errors="replace") + "\n"
+            return
+        time.sleep(interval)
+
+
+def follow_jobs(t, jobs, regex, args):
+    """Follow running jobs at the same time, printing new (matching) lines from
+    each as they arrive, prefixed with the job number. Exits with an error if
+    following any of them failed."""
+    output = queue.Queue()
+
+    def follow(job):
+        try:
+            lines = follow_log(t, job.id, args.interval, args.api)
+            if regex and args.count:
+                count = sum(1 for line in lines if regex.search(line))
+                output.put((job, f"{count}\n"))
+            elif regex:
+                for line in grep(lines, regex, args.before_context, args.after_context):
+                    output.put((job, line))
+            else:
+                for line in lines:
+                    output.put((job, line))
+        except Exception as e:
+            # Pass it to the main thread, which would otherwise wait forever
+            output.put((job, e))
+        finally:
+            output.put((job, None))
+
+    for job in jobs:
+        threading.Thread(target=follow, args=(job,), daemon=True).start()
+
+    running = len(jobs)
+    failed = False
+    while running:
+        job, line = output.get()
+        if line is None:
+            running -= 1
+            if not args.quiet:
+                print(f"#{job.number} finished")
+        elif isinstance(line, Exception):
+            failed = True
+            print(f"#{job.number} failed: {line!r}", file=sys.stderr)
+        elif args.quiet:
+            sys.stdout.write(line)
+        else:
+            sys.stdout.write(f"#{job.number}: {line}")
+        sys.stdout.flush()
+    if failed:
+        sys.exit(1)
+
+
+class AnyPattern:
+    """Several regexes searched like one, compiled separately so each can start
+    with its own global flags, such as (?i)"""
+
+    def __init__(self, patterns):
+        self.regexes = [re.compile(pattern) for pattern in patterns]
+
+    def search(self, line):
+        for regex in self.regexes:
+            match = regex.search(line)
+            if match:
+                return match
+        return None
+
+
+def grep(lines, regex, before=0, after=0):
+    """Yield matching lines with `before` and `after` lines of context, and "--"
+    between separate groups, like grep. Only keeps `before` lines in memory."""
+    previous = collections.deque(maxlen=before)
+    remaining = 0
+    last = None
+    for number, line in enumerate(lines, start=1):
+        if regex.search(line):
+            first = number - len(previous)
+            if (before or after) and last is not None and first > last + 1:
+                yield "--\n"
+            yield from previous
+            previous.clear()
+            yield line
+            last = number
+            remaining = after
+        elif remaining:
+            yield line
+            last = number
+            remaining -= 1
+        else:
+            previous.append(line)
+
+
+def fetch_job_logs(
+    t, jobs, workers, store=None, follow=False, known=None, api=DEFAULT_API
+):
+    """Fetch jobs and their logs concurrently, yielding them in job order as soon as
+    each one and all those before it are ready.
+
+    `jobs` is a list of job IDs and the job numbers wanted from that job's build,
+    or None for any. `known` is a dict of job IDs to jobs which needn't be fetched.
+    """
+    known = known or {}
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def submit():
+            for job in itertools.islice(jobs, 1):
+                pending.append(
+                    executor.submit(
+                        fetch_job_log, t, *job, store, follow, known.get(job[0]), api
+                    )
+                )
+
+        # Only open a few logs ahead of the one being read, as each is a
+        # connection or a file until it's read
+        pending = collections.deque()
+        for _ in range(workers):
+            submit()
+        try:
+            while pending:
+                result = pending.popleft().result()
+                submit()
+                if result:
+                    yield result
+        finally:
+            # Stopped early, so close the logs opened ahead
+            for future in pending:
+                if not future.cancel() and future.exception() is None:
+                    result = future.result()
+                    if result and result[1] is not None:
+                        result[1].close()
+
+
+def index_builds(t, slug, first, workers, store, api=DEFAULT_API):
+    """Add the finished jobs of each build from `first`, or else from the oldest
+    with jobs which were still running last time, or else from the one after the
+    newest already indexed, up to the latest build"""
+    index = LogIndex(api=api)
+    resume = index.resume_from(slug)
+    latest = int(t.builds(slug=slug)[0].number)
+    if first is None:
+        first = latest if resume is None else resume
+
+    builds = fetch_builds(t, slug, range(first, latest + 1), workers)
+    for build in builds:
+        print(f"Indexing #{build.number}")
+        jobs = [
+            (job_id, None) for job_id in sorted(build.job_ids) if job_id not in index
+        ]
+        for job, log in fetch_job_logs(t, jobs, workers, store, api=api):
+            with log:
+                # Running jobs' logs can still change, index them later
+                if job.state in FINISHED_STATES:
+                    index.add(slug, int(build.number), job.number, job.id, log)
+                else:
+                    index.defer(slug, int(build.number), job.id)
+    index.close()
+
+
+def search_index(store, slug, regex, patterns, since, until):
+    """Print build, job, line number and line for each match in the indexed logs"""
+    index = LogIndex(api=store.api)
+    matches = index.search(store, slug, regex, patterns, since, until)
+    for build, job, number, line in matches:
+        sys.stdout.write(f"{build}\t{job}\t{number}\t{line}")
+    index.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Grep logs of each build job for a Travis CI build",
@@ -33,13 +330,97 @@ if __name__ == "__main__":
         "-s", "--slug", default="python-pillow/Pillow", help="Repo slug"
     )
     parser.add_argument(
-        "-p", "--pattern", help="Pattern to find. Omit to print full log"
+        "-p",
+        "--pattern",
+        action="append",
+        help="Pattern to find, can be repeated to find any of them. "
+        "Omit to print full log",
+    )
+    parser.add_argument(
+        "-A", "--after-context", type=int, default=0, help="Lines after each match"
+    )
+    parser.add_argument(
+        "-B", "--before-context", type=int, default=0, help="Lines before each match"
+    )
+    parser.add_argument(
+        "-C", "--context", type=int, help="Lines before and after each match"
+    )
+    parser.add_argument(
+        "-c",
+        "--count",
+        action="store_true",
+        help="Only print how many lines match in each log",
     )
     parser.add_argument(
         "-n",
         "--number",
+        type=parse_numbers,
+        default={},
+        help="Build number (and optional job number), a range of builds (3900-3928) "
+        "or a list of them (3910,3915.2). Omit for latest build",
+    )
+    parser.add_argument(
+        "--since", type=int, help="Builds from this number, instead of --number"
+    )
+    parser.add_argument(
+        "--until",
+        type=int,
+        help="Builds up to this number, with --since. Omit for latest build",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="How many jobs and logs to fetch at once",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write logs in the local log store",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=DEFAULT_MAX_BYTES // 1024 // 1024,
+        help="Size limit for the local log store, in MiB",
+    )
+    parser.add_argument("--api", default=DEFAULT_API, help="Travis CI API URL")
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Add finished builds' logs to the local search index, from --number "
+        "or else after the newest indexed build, up to the latest",
+    )
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="Search the local index for --pattern instead of fetching logs, "
+        "in builds from --number onwards",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Sync new builds into the local build history database, "
+        "then find builds and finished jobs there instead of asking the API",
+    )
+    parser.add_argument(
+        "--steps",
+        action="store_true",
+        help="Instead of grepping, show how long each step of each job took, "
+        "and the total for each step across each build",
+    )
+    parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="Keep printing new lines from running jobs until they finish",
+    )
+    parser.add_argument(
+        "--interval",
         type=float,
-        help="Build number (and optional job number). Omit for latest build",
+        default=5,
+        help="Seconds between checking running jobs for new lines, with --follow",
     )
     parser.add_argument(
         "-q",
@@ -50,36 +431,135 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    build_no, job_no = split_build_number(args.number)
+    # Where to start indexing or searching
+    since = args.since or min(args.number, default=None)
+
+    if args.context is not None:
+        args.before_context = args.after_context = args.context
+    if args.pattern:
+        # One pass over each log for all the patterns
+        regex = (
+            re.compile(args.pattern[0])
+            if len(args.pattern) == 1
+            else AnyPattern(args.pattern)
+        )
+
+    store = (
+        None
+        if args.no_cache
+        else LogStore(max_bytes=args.cache_mb * 1024 * 1024, api=args.api)
+    )
+    if (args.index or args.search) and store is None:
+        parser.error("--index and --search need the local log store")
+
+    if args.search:
+        if not args.pattern:
+            parser.error("--search needs a --pattern")
+        search_index(store, args.slug, regex, args.pattern, since, args.until)
+        sys.exit()
 
     # Slow to import, no need for --help
     from travispy import TravisPy  # pip install travispy
 
-    t = TravisPy()
+    # One client for all the builds, sharing its connections between threads
+    t = TravisPy(uri=args.api)
+    share_session(t, args.jobs)
     # repo = t.repo(args.slug)
 
-    build = t.builds(slug=args.slug, number=build_no)[0]
+    if args.index:
+        index_builds(t, args.slug, since, args.jobs, store, args.api)
+        sys.exit()
 
-    job_ids = sorted(build.job_ids)
+    history = None
+    known = {}
+    if args.local:
+        history = BuildHistory(api=args.api)
+        # Just the latest build when no numbers are given
+        history.sync(args.slug, since=since or -1)
+        last = history.last_build(args.slug)
+        known = {
+            job.id: job
+            for job in history.jobs(args.slug, since or last, args.until)
+            if job.state in FINISHED_STATES
+        }
 
-    for job_id in job_ids:
-        job = t.job(job_id)
+    selected = args.number
+    if args.since:
+        if args.until:
+            until = args.until
+        elif history:
+            until = last
+        else:
+            until = int(t.builds(slug=args.slug)[0].number)
+        selected = dict.fromkeys(range(args.since, until + 1))
+    if selected and history:
+        builds = [
+            build
+            for build in history.builds(args.slug, min(selected), max(selected))
+            if build.number in selected
+        ]
+    elif selected:
+        builds = fetch_builds(t, args.slug, sorted(selected), args.jobs)
+    elif history:
+        builds = history.builds(args.slug, last, last)
+    else:
+        builds = t.builds(slug=args.slug)[:1]
 
-        if job_no:
-            # Job number specified, only print that one
-            if str(args.number) != job.number:
-                continue
+    # Job numbers specified, only print those
+    jobs = [
+        (job_id, selected.get(int(build.number)))
+        for build in builds
+        for job_id in sorted(build.job_ids)
+    ]
 
+    last_build = None
+    running = []
+    build_totals = {}
+    for job, log in fetch_job_logs(
+        t, jobs, args.jobs, store, args.follow, known, args.api
+    ):
+        if log is None:
+            running.append(job)
+            continue
+        build_number = job.number.split(".")[0]
+        if build_number != last_build:
+            if build_totals:
+                print()
+                print(f"Build #{last_build} steps")
+                print_totals(build_totals)
+                build_totals = {}
+            if not args.quiet:
+                print()
+                print(f"Build #{build_number}")
+            last_build = build_number
         if not args.quiet:
             print()
-            print(f"#{job.number}")
-        log = t.log(job.log_id)
-        if args.pattern:
-            lines = log.body.splitlines()
-            for line in lines:
-                if re.search(args.pattern, line):
-                    print(line)
-        else:
-            print(log.body.encode("utf-8"))
+            print(f"#{job.number}", flush=True)
+        # Stream each log rather than reading it all into memory
+        with log:
+            if args.steps:
+                steps = parse_steps(log)
+                for step in steps:
+                    print(f"{format_seconds(step.duration)}\t{step.name}")
+                add_totals(build_totals, total_by_step(steps))
+            elif not args.pattern:
+                shutil.copyfileobj(log, sys.stdout)
+            elif args.count:
+                print(sum(1 for line in log if regex.search(line)))
+            else:
+                sys.stdout.writelines(
+                    grep(log, regex, args.before_context, args.after_context)
+                )
+
+    if build_totals:
+        print()
+        print(f"Build #{last_build} steps")
+        print_totals(build_totals)
+
+    if running:
+        if not args.quiet:
+            print()
+            print("Following", ", ".join(f"#{job.number}" for job in running))
+        follow_jobs(t, running, regex if args.pattern else None, args)
 
 # End of file
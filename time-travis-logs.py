@@ -2,19 +2,254 @@
 """TODO
 
 For example: python time-travis-logs.py -n 3928
+For example: python time-travis-logs.py --local --trend --format csv
 """
 
 from __future__ import annotations
 
 import argparse
+import csv
+import json
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from statistics import NormalDist
 
-import dateutil.parser as dp
+from travis_history import BuildHistory
+from travis_log_steps import (
+    add_totals,
+    format_seconds,
+    parse_steps,
+    print_totals,
+    total_by_step,
+)
+from travis_log_store import DEFAULT_API, LogStore, open_log
 
 
 def iso2epoch(timestamp):
-    parsed_t = dp.parse(timestamp)
-    t_in_seconds = parsed_t.strftime("%s")
-    return int(t_in_seconds)
+    """Seconds since the epoch, taking timestamps without a timezone as UTC rather
+    than local time"""
+    parsed_t = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if parsed_t.tzinfo is None:
+        parsed_t = parsed_t.replace(tzinfo=timezone.utc)
+    return int(parsed_t.timestamp())
+
+
+def parse_timestamps(timestamps):
+    """Seconds since the epoch for a list of UTC ISO 8601 timestamps, parsed all at
+    once, with NaN for missing ones"""
+    import numpy as np  # pip install numpy
+
+    parsed = np.array(
+        [
+            timestamp.removesuffix("Z") if timestamp else "NaT"
+            for timestamp in timestamps
+        ],
+        dtype="datetime64[s]",
+    )
+    seconds = parsed.astype("int64").astype(float)
+    seconds[np.isnat(parsed)] = np.nan
+    return seconds
+
+
+def rolling_percentiles(values, window, percentiles=(50, 95)):
+    """Percentiles of each value and up to `window - 1` before it, ignoring NaN"""
+    import numpy as np  # pip install numpy
+
+    padded = np.concatenate([np.full(window - 1, np.nan), values])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+    with warnings.catch_warnings():
+        # Windows with nothing but NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanpercentile(windows, percentiles, axis=1)
+
+
+def change_points(values, min_size=10, alpha=0.01, min_shift=60):
+    """Where the mean of the values shifts, as a list of (index, shift), by binary
+    segmentation.
+
+    Each segment is split where Welch's t statistic between the two sides is
+    largest, if it's significant at `alpha` after a Bonferroni correction for the
+    number of places it could have been split, and the shift is at least
+    `min_shift`. Both sides need `min_size` values, for the normal approximation.
+    """
+    import numpy as np  # pip install numpy
+
+    found = []
+    segments = [(0, len(values))]
+    while segments:
+        start, stop = segments.pop()
+        x = values[start:stop]
+        n = len(x)
+        if n < 2 * min_size:
+            continue
+        # Sizes of the left side for each possible split
+        k = np.arange(min_size, n - min_size + 1)
+        sums = np.cumsum(x)
+        squares = np.cumsum(x * x)
+        left_mean = sums[k - 1] / k
+        right_mean = (sums[-1] - sums[k - 1]) / (n - k)
+        left_var = (squares[k - 1] - k * left_mean**2) / (k - 1)
+        right_var = (squares[-1] - squares[k - 1] - (n - k) * right_mean**2) / (
+            n - k - 1
+        )
+        shift = right_mean - left_mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.abs(shift) / np.sqrt(left_var / k + right_var / (n - k))
+        t = np.nan_to_num(t, nan=0.0)
+
+        best = np.argmax(t)
+        critical = NormalDist().inv_cdf(1 - alpha / (2 * len(k)))
+        if t[best] > critical and abs(shift[best]) >= min_shift:
+            split = start + int(k[best])
+            found.append((split, float(shift[best])))
+            segments += [(start, split), (split, stop)]
+    return sorted(found)
+
+
+def queue_waits(builds, jobs):
+    """Mean seconds each build's jobs waited between being created and starting,
+    NaN when not known"""
+    import numpy as np  # pip install numpy
+
+    position = {build.number: i for i, build in enumerate(builds)}
+    jobs = [job for job in jobs if job.build in position]
+    waits = parse_timestamps([job.started_at for job in jobs]) - parse_timestamps(
+        [job.created_at for job in jobs]
+    )
+    index = np.array([position[job.build] for job in jobs], dtype=int)
+    known = ~np.isnan(waits)
+    totals = np.bincount(index[known], waits[known], minlength=len(builds))
+    counts = np.bincount(index[known], minlength=len(builds))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return totals / counts
+
+
+def trends(builds, jobs, window, min_shift):
+    """A row of timings for each finished build, with rolling percentiles of the
+    wall-clock time, and the shift where a passing build's time changed
+    significantly"""
+    import numpy as np  # pip install numpy
+
+    builds = [build for build in builds if build.finished_at]
+    if not builds:
+        return []
+    started = parse_timestamps([build.started_at for build in builds])
+    wall = parse_timestamps([build.finished_at for build in builds]) - started
+    job_time = np.array(
+        [getattr(build, "duration", None) for build in builds], dtype=float
+    )
+    queue = queue_waits(builds, jobs)
+    p50, p95 = rolling_percentiles(wall, window)
+
+    # Failed and errored builds can stop early, so only look for shifts in passes
+    passed = np.array([build.state == "passed" for build in builds], dtype=bool)
+    passed &= ~np.isnan(wall)
+    indexes = np.flatnonzero(passed)
+    shifts = {
+        indexes[i]: shift
+        for i, shift in change_points(wall[passed], min_shift=min_shift)
+    }
+
+    rows = []
+    for i, build in enumerate(builds):
+        rows.append(
+            {
+                "number": int(build.number),
+                "state": build.state,
+                "started_at": build.started_at,
+                "wall": wall[i],
+                "job_time": job_time[i],
+                "queue": queue[i],
+                "p50": p50[i],
+                "p95": p95[i],
+                "shift": shifts.get(i),
+            }
+        )
+    return rows
+
+
+def format_duration(seconds):
+    if seconds is None or seconds != seconds:
+        # Not known
+        return "-"
+    sign = "-" if seconds < 0 else ""
+    m, s = divmod(round(abs(seconds)), 60)
+    return f"{sign}{m:02}m{s:02}s"
+
+
+def print_trends(rows, output_format):
+    if output_format == "text":
+        print("Build   State     Wall    Jobs    Queue   p50     p95")
+        for row in rows:
+            print(
+                f"{row['number']:<7} {row['state']:<9} "
+                + " ".join(
+                    f"{format_duration(row[key]):<7}"
+                    for key in ("wall", "job_time", "queue", "p50", "p95")
+                ).rstrip()
+            )
+        print()
+        for row in rows:
+            if row["shift"] is not None:
+                change = "slower" if row["shift"] > 0 else "faster"
+                print(
+                    f"#{row['number']}: passing builds {change} by "
+                    f"{format_duration(abs(row['shift']))}"
+                )
+        return
+
+    # NaN isn't valid JSON, and is clearer left empty in CSV
+    rows = [
+        {
+            key: (
+                (None if value != value else round(value, 1))
+                if isinstance(value, float)
+                else value
+            )
+            for key, value in row.items()
+        }
+        for row in rows
+    ]
+    if output_format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=rows[0] if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            print(json.dumps(row))
+
+
+def fetch_window(t, slug, last, window, workers):
+    """The builds numbered from `window` before `last` up to `last`, oldest first.
+
+    Rather than one request per build, fetch pages of builds from the list endpoint.
+    Each page holds the builds before a given number, so the page boundaries can be
+    worked out from the first one and the rest fetched at the same time.
+    """
+    if last is None:
+        page = t.builds(slug=slug)
+        if not page:
+            return []
+        last = int(page[0].number)
+    else:
+        page = t.builds(slug=slug, after_number=last + 1)
+    first = last - window + 1
+    builds = {int(build.number): build for build in page}
+
+    if page:
+        # Where builds are missing a page reaches further back, overlapping the
+        # next one, so none are skipped
+        size = len(page)
+        afters = range(last + 1 - size, first, -size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for page in executor.map(
+                lambda after: t.builds(slug=slug, after_number=after), afters
+            ):
+                builds.update((int(build.number), build) for build in page)
+
+    return [builds[number] for number in sorted(builds) if first <= number <= last]
 
 
 if __name__ == "__main__":
@@ -30,6 +265,57 @@ if __name__ == "__main__":
     parser.add_argument(
         "-n", "--number", type=int, help="Build number. Omit for latest build"
     )
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        default=100,
+        help="How many builds to time, up to and including --number",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="How many pages of builds to fetch at once",
+    )
+    parser.add_argument("--api", default=DEFAULT_API, help="Travis CI API URL")
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Sync new builds into the local build history database, "
+        "then read the window from there instead of the API",
+    )
+    parser.add_argument(
+        "--steps",
+        action="store_true",
+        help="Also show how long each step took in each build, summed over its "
+        "jobs, and the total for each step over all the builds",
+    )
+    parser.add_argument(
+        "--trend",
+        action="store_true",
+        help="Show wall-clock, summed job and queue times for each build, with "
+        "rolling percentiles, and find where passing builds got slower or faster",
+    )
+    parser.add_argument(
+        "--rolling",
+        type=int,
+        default=20,
+        help="How many builds the rolling percentiles cover, with --trend",
+    )
+    parser.add_argument(
+        "--min-shift",
+        type=float,
+        default=60,
+        help="Smallest change in seconds to report, with --trend",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("text", "csv", "ndjson"),
+        default="text",
+        help="Output format for --trend",
+    )
     parser.add_argument(
         "-q",
         "--quiet",
@@ -38,21 +324,53 @@ if __name__ == "__main__":
         help="Quiet means only print from logs, with no extra build info",
     )
     args = parser.parse_args()
+    if args.trend and args.steps:
+        parser.error("--trend and --steps can't be used together")
+    if args.rolling < 1:
+        parser.error("--rolling should be at least 1")
 
-    # Slow to import, no need for --help
-    from travispy import TravisPy  # pip install travispy
+    jobs = []
+    if args.local:
+        history = BuildHistory(api=args.api)
+        if args.number is None:
+            history.sync(args.slug, since=-args.window)
+        else:
+            history.sync(args.slug, since=args.number - args.window + 1)
+        last = args.number or history.last_build(args.slug) or 0
+        builds = history.builds(args.slug, last - args.window + 1, last)
+        if args.trend:
+            # For queue times
+            jobs = history.jobs(args.slug, last - args.window + 1, last)
+        history.close()
+    else:
+        # Slow to import, no need for --help
+        from travispy import TravisPy  # pip install travispy
 
-    t = TravisPy()
+        t = TravisPy(uri=args.api)
+        builds = fetch_window(t, args.slug, args.number, args.window, args.jobs)
 
-    for number in range(args.number - 100, args.number):
-        # print(number)
+    if args.trend:
+        rows = trends(builds, jobs, args.rolling, args.min_shift)
+        print_trends(rows, args.format)
+        sys.exit()
 
-        build = t.builds(slug=args.slug, number=number)[0]
+    store = LogStore(api=args.api)
+    all_totals = {}
 
-        # print(build['started_at'])
-        # print(build['finished_at'])
-        start_seconds = iso2epoch(build["started_at"])
-        finish_seconds = iso2epoch(build["finished_at"])
+    for build in builds:
+        number = build.number
+        if not build.finished_at:
+            # Still running
+            continue
+        if not build.started_at:
+            # Cancelled before it started
+            print(f"-\t{int(number)}")
+            continue
+
+        # print(build.started_at)
+        # print(build.finished_at)
+        start_seconds = iso2epoch(build.started_at)
+        finish_seconds = iso2epoch(build.finished_at)
         # print(start_seconds)
         # print(finish_seconds)
         seconds = finish_seconds - start_seconds
@@ -60,6 +378,20 @@ if __name__ == "__main__":
         m, s = divmod(seconds, 60)
         print(f"{int(m):02}m{int(s):02}s\t{int(number)}")
 
+        if args.steps:
+            totals = {}
+            for job_id in build.job_ids:
+                with open_log(store, job_id, api=args.api) as log:
+                    add_totals(totals, total_by_step(parse_steps(log)))
+            for name, step_seconds in totals.items():
+                print(f"{format_seconds(step_seconds)}\t{int(number)}\t{name}")
+            add_totals(all_totals, totals)
+
+    if all_totals:
+        print()
+        print("Total for each step")
+        print_totals(all_totals)
+
 
 #     job_ids = sorted(build.job_ids)
 #
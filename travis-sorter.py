@@ -7,6 +7,9 @@ Requires the Travis Client CLI
 
 https://github.com/travis-ci/travis.rb#installation
 
+The simulation and ordering is in travis_scheduler.py, which can be imported on its
+own.
+
 # Example
 
 $ # Check build 22 of hugovk/numpy, and skip the first job (it's a single stage)
@@ -84,95 +87,315 @@ After:
 from __future__ import annotations
 
 import argparse
+import json
+import os
 import re
+import statistics
 import subprocess
 import sys
-
-count = 1
-
-
-def summarise(jobs):
-    end = 0
+import time
+from pathlib import Path
+
+from travis_history import BuildHistory
+from travis_log_store import DEFAULT_API
+from travis_scheduler import (
+    Job,
+    critical_path,
+    critical_path_order,
+    draw_lengths,
+    find_knee,
+    group_by,
+    link_stages,
+    monte_carlo_makespans,
+    order_jobs,
+    order_pools,
+    pools_bound,
+    simulate,
+    sweep_makespans,
+)
+
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "ci-tools"
+    / "travis-sorter"
+)
+CACHE_MAX_AGE = 90 * 24 * 60 * 60
+CACHE_MAX_BUILDS = 1000
+FINISHED_STATES = {"passed", "failed", "errored", "canceled"}
+
+
+def format_minutes(minutes):
+    """Show whole minutes as ints, and fractional ones to the second"""
+    if minutes == int(minutes):
+        return str(int(minutes))
+    m, s = divmod(round(minutes * 60), 60)
+    return f"{m}m{s:02d}s"
+
+
+def summarise(schedule):
+    end = schedule.makespan
     print("ID Duration in mins")
-    for job in jobs:
-        before = " " * job.started
-        active = "*" * job.length
+    for job, started, ended in schedule:
+        # The chart has a one-minute resolution, the end time is exact
+        before = " " * round(started)
+        active = "*" * (round(ended) - round(started))
         print(f"{job.id:2d} {before}{active}")
-        if job.started + job.length > end:
-            end = job.started + job.length
-    # for job in jobs:
-    #     print(job)
-    print("End:", end)
-    print("   " + "-" * end)
-
-
-class Job:
-    def __init__(self, length):
-        global count
-        self.id = count
-        count += 1
-        self.length = length
-        self.started = -1
-        self.status = "not started"
-        self.ended = False
-
-    def __str__(self):
-        return (
-            f"{self.id}"
-            f"\tLength: {self.length}"
-            f"\tStarted: {self.started}"
-            f"\tEnded: {self.ended}"
-        )
+    print("End:", format_minutes(end))
+    print("   " + "-" * round(end))
 
 
-def count_status(jobs, status):
-    number = 0
-    for job in jobs:
-        if job.status == status:
-            number += 1
-    return number
+def run(jobs, limit, pool_limits):
+    """Simulate and show the jobs in this order"""
+    try:
+        schedule = simulate(jobs, limit, pool_limits)
+    except ValueError as e:
+        sys.exit(e)
+    summarise(schedule)
+    report_groups(schedule)
+    return schedule
+
+
+def load_spec(filename):
+    """Load jobs from a JSON file like:
+
+    {"jobs": [
+        {"name": "lint", "length": 2, "stage": "lint"},
+        {"name": "py313", "length": 8, "stage": "test", "pool": "osx"},
+        {"name": "py39", "samples": [6, 7, 11]},
+        {"name": "coverage", "length": 1, "needs": ["py39"]}
+    ]}
+
+    Lengths are in minutes. Every job in a stage needs all the jobs in the stage
+    before it, and "needs" adds explicit edges to other jobs by name. As in Travis
+    CI, a job without a stage is in the same stage as the job before it, or "test"
+    for the first. The optional pool is the runner pool, such as the OS. Samples
+    are lengths from past builds, and the length defaults to their median.
+    """
+    with open(filename) as f:
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        spec = spec["jobs"]
 
+    jobs = []
+    stage = "test"
+    for item in spec:
+        samples = item.get("samples", [])
+        stage = item.get("stage", stage)
+        job = Job(
+            item.get("length") or statistics.median(samples),
+            name=item.get("name"),
+            stage=stage,
+            pool=item.get("pool"),
+        )
+        if samples:
+            job.samples = samples
+        jobs.append(job)
+    by_name = {job.name: job for job in jobs if job.name is not None}
+    for job, item in zip(jobs, spec):
+        for name in item.get("needs", []):
+            try:
+                job.needs.append(by_name[name])
+            except KeyError:
+                sys.exit(f"Job {job.name} needs unknown job {name}")
+    return jobs
+
+
+def report_groups(schedule):
+    """Show the critical path, and when each stage and pool ran"""
+    jobs = schedule.jobs
+    if any(job.needs for job in jobs):
+        path = critical_path(jobs)
+        print(
+            "Critical path:",
+            " -> ".join(str(job.id) for job in path),
+            "=",
+            format_minutes(sum(job.length for job in path)),
+        )
+    for attribute in ("stage", "pool"):
+        groups = group_by(jobs, attribute)
+        if len(groups) < 2:
+            continue
+        times = {job: (started, ended) for job, started, ended in schedule}
+        for group in groups:
+            started = min(times[job][0] for job in group)
+            ended = max(times[job][1] for job in group)
+            print(
+                f"{attribute.title()} {getattr(group[0], attribute)}: "
+                f"{format_minutes(started)} to {format_minutes(ended)} "
+                f"= {format_minutes(ended - started)}"
+            )
+
+
+def sweep(jobs, limits):
+    """Show the makespan before and after sorting for each concurrency limit"""
+    import numpy as np  # pip install numpy
+
+    limits = list(limits)
+    before = np.zeros(len(limits))
+    after = np.zeros(len(limits))
+    bound = np.zeros(len(limits))
+    # Stages run one after the other, so their makespans add up
+    for stage in group_by(jobs, "stage"):
+        lengths = [job.length for job in stage]
+        before += sweep_makespans(lengths, limits)
+        after += sweep_makespans(sorted(lengths, reverse=True), limits)
+        bound += np.maximum(max(lengths), sum(lengths) / np.asarray(limits))
+
+    width = 50 / max(before.max(), 1)
+    print("Limit Before  After  Bound")
+    for limit, b, a, lb in zip(limits, before, after, bound):
+        print(
+            f"{limit:5d} {format_minutes(b):>6} {format_minutes(a):>6} "
+            f"{format_minutes(lb):>6} {'*' * round(a * width)}"
+        )
+    print()
+    print("Knee before:", find_knee(limits, before))
+    print("Knee after: ", find_knee(limits, after))
+
+
+def monte_carlo(jobs, limit, simulations, seed, strategy, budget):
+    """Simulate the current and some new orders with lengths drawn from past builds,
+    and show which order has the lowest 95th percentile makespan"""
+    import numpy as np  # pip install numpy
+
+    rng = np.random.default_rng(seed)
+    # All orders get the same draws, so they're compared fairly
+    draws = draw_lengths(jobs, simulations, rng)
+    column = {job: i for i, job in enumerate(jobs)}
+
+    candidates = {
+        "current": None,
+        strategy: strategy,
+        "longest median first": lambda job: np.median(job.samples),
+        "longest mean first": lambda job: np.mean(job.samples),
+        "longest p95 first": lambda job: np.percentile(job.samples, 95),
+    }
+
+    def order(key):
+        ordered = []
+        # Stages run one after the other, so order each one on its own
+        for stage in group_by(jobs, "stage"):
+            if key is None:
+                ordered.append(stage)
+            elif callable(key):
+                ordered.append(sorted(stage, key=key, reverse=True))
+            else:
+                ordered.append(order_jobs(stage, limit, key, budget)[0])
+        return ordered
+
+    print(f"{'Order':<21} {'p50':>6} {'p95':>6} {'Mean':>6}")
+    orders = {}
+    p95s = {}
+    for name, key in candidates.items():
+        orders[name] = order(key)
+        # The stages' makespans add up
+        makespans = sum(
+            monte_carlo_makespans(draws[:, [column[job] for job in stage]], limit)
+            for stage in orders[name]
+        )
+        p50, p95s[name] = np.percentile(makespans, [50, 95])
+        print(
+            f"{name:<21} {format_minutes(p50):>6} {format_minutes(p95s[name]):>6} "
+            f"{format_minutes(makespans.mean()):>6}"
+        )
 
-def simulate(jobs, limit):
-    time = 0
+    best = min(p95s, key=p95s.get)
+    print()
+    print("Lowest p95:", best)
+    print("Order:", [job.id for stage in orders[best] for job in stage])
 
-    # summarise(jobs)
 
-    while True:
-        # Check if any have ended
-        for job in jobs:
-            if job.status == "active":
-                if time >= job.started + job.length:
-                    # print(f"{count_status(jobs, 'active')}/{limit} Finished:")
-                    job.ended = time
-                    job.status = "finished"
-                    # print(job)
+def parse_sweep(value):
+    """1..N or N to range(1, N + 1)"""
+    start, _, stop = value.rpartition("..")
+    return range(int(start or 1), int(stop) + 1)
 
-        # Check if any can start
-        for job in jobs:
-            if job.status == "not started":
-                if count_status(jobs, "active") < limit:
-                    # print(f"{count_status(jobs, 'active')}/{limit} Starting:")
-                    job.started = time
-                    job.status = "active"
-                    # print(job)
 
-        time += 1
+def cache_path(repo, number, com):
+    endpoint = "com" if com else "org"
+    return CACHE_DIR / f"{endpoint}-{repo.replace('/', '-')}-{number}.json"
 
-        # Exit loop?
-        if count_status(jobs, "finished") == len(jobs):
-            break
 
-    summarise(jobs)
+def read_cache(path):
+    """Jobs for a finished build, or None on a miss"""
+    try:
+        with open(path) as f:
+            items = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Keep recently used builds from being evicted
+    os.utime(path)
+    return [Job(**item) for item in items]
+
+
+def write_cache(path, jobs):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(
+            [
+                {"length": job.length, "stage": job.stage, "pool": job.pool}
+                for job in jobs
+            ],
+            f,
+        )
+    evict_cache()
 
 
-def do_thing(repo, number, com):
+def evict_cache():
+    """Remove builds not used for CACHE_MAX_AGE, then the least recently used
+    ones until there are at most CACHE_MAX_BUILDS"""
+    entries = sorted(
+        (entry.stat().st_mtime, entry.path)
+        for entry in os.scandir(CACHE_DIR)
+        if entry.name.endswith(".json")
+    )
+    cutoff = time.time() - CACHE_MAX_AGE
+    for i, (mtime, path) in enumerate(entries):
+        if mtime < cutoff or i < len(entries) - CACHE_MAX_BUILDS:
+            os.remove(path)
+
+
+def read_history(history, repo, number):
+    """Jobs for a finished build from the local build history, or None if it's not
+    there"""
+    builds = history.builds(repo, number, number)
+    if not builds or builds[0].state not in FINISHED_STATES:
+        return None
+    # Like travis show, leave out canceled jobs
+    jobs = [
+        Job(job.duration / 60, stage=job.stage, pool=job.os)
+        for job in history.jobs(repo, number, number)
+        if job.state in FINISHED_STATES - {"canceled"} and job.duration is not None
+    ]
+    print([job.length for job in jobs], "(local history)")
+    return jobs
+
+
+def get_jobs(repo, number, args, history=None):
+    """Jobs for a build, from the local build history if given and it's there, or
+    else from travis show"""
+    if history is not None and number is not None:
+        jobs = read_history(history, repo, int(number))
+        if jobs is not None:
+            return jobs
+    return do_thing(repo, number, args.com, not args.no_cache, args.refresh)
+
+
+def do_thing(repo, number, com, cache=True, refresh=False):
     cmd = f"travis show -r {repo} {number or ''}"
     if com:
         cmd += " --com"
     # cmd = f"travis show --com -r {repo} {number or ''}"
     print(cmd)
 
+    # Only finished builds are cached, and the latest build could be any number
+    path = cache_path(repo, number, com) if cache and number else None
+    if path and not refresh:
+        jobs = read_cache(path)
+        if jobs is not None:
+            print([job.length for job in jobs], "(cached)")
+            return jobs
+
     exitcode = 0
     # For offline testing
     output = """Build #4:  Upgrade Python syntax with pyupgrade https://github.com/asottile/pyupgrade
@@ -224,16 +447,32 @@ Finished:      2018-10-27 18:54:14
         print(output)
         sys.exit(exitcode)
 
-    minutes = []
-    matches = re.findall(r"(pass|fail|error)ed.* (\d+) min (\d+)? ", output)
-    for match in matches:
-        status, m, s = match
-        s = 0 if s == "" else int(s)
+    jobs = []
+    for line in output.splitlines():
+        match = re.search(r"(pass|fail|error)ed.* (\d+) min (\d+)? ", line)
+        if not match:
+            continue
+        status, m, s = match.groups()
+        s = 0 if s is None else int(s)
         s += int(m) * 60
-        minutes.append(round(s / 60))
+        # Stages show up as another column in newer builds
+        stage = re.search(r"stage: ([^,]+)", line)
+        pool = re.search(r"os: ([^,]+)", line)
+        # Keep the seconds, the simulation is exact
+        jobs.append(
+            Job(
+                s / 60,
+                stage=stage and stage.group(1).strip(),
+                pool=pool and pool.group(1).strip(),
+            )
+        )
+
+    state = re.search(r"^State:\s+(\w+)", output, re.MULTILINE)
+    if path and state and state.group(1) in FINISHED_STATES:
+        write_cache(path, jobs)
 
-    print(minutes)
-    return minutes
+    print([job.length for job in jobs])
+    return jobs
 
 
 if __name__ == "__main__":
@@ -244,54 +483,194 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "input",
-        nargs="+",
+        nargs="*",
         help="Either: times for each build job (minutes), "
         "or an org/repo slug and optionally build number",
     )
     parser.add_argument(
         "--com", action="store_true", help="Check travis-ci.com, not .org"
     )
+    parser.add_argument(
+        "--api",
+        default=DEFAULT_API,
+        help="Travis CI API URL for the local build history, with --local",
+    )
     parser.add_argument(
         "-l", "--limit", type=int, default=5, help="Concurrent jobs limit"
     )
     parser.add_argument(
         "-s", "--skip", type=int, default=0, help="Skip X jobs at the start"
     )
+    parser.add_argument(
+        "--strategy",
+        choices=("lpt", "multifit", "exact"),
+        default="lpt",
+        help="How to find the new order: longest first, MULTIFIT bin packing, "
+        "or branch and bound",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=10,
+        help="Time limit in seconds for the exact strategy",
+    )
+    parser.add_argument(
+        "--spec",
+        help="JSON file of jobs with lengths, stages and needs, instead of input",
+    )
+    parser.add_argument(
+        "-p",
+        "--pool-limit",
+        action="append",
+        default=[],
+        metavar="POOL=N",
+        help="Concurrent jobs limit for a runner pool such as an OS (osx=2), "
+        "can be repeated",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=parse_sweep,
+        metavar="1..N",
+        help="Show the makespan before and after sorting longest first "
+        "for each concurrency limit in this range, instead of one --limit",
+    )
+    parser.add_argument(
+        "--monte-carlo",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Run N simulations with job lengths drawn from past builds, "
+        "and find the order with the lowest 95th percentile makespan",
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=1,
+        help="How many builds, up to and including the build number, "
+        "to take job lengths from",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed for --monte-carlo")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Don't read or write finished builds in {CACHE_DIR}",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Sync new builds into the local build history database, "
+        "and take job lengths from there instead of travis show",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Run travis show even for cached builds, and update the cache",
+    )
     args = parser.parse_args()
 
-    # If all ints
-    try:
-        for x in args.input:
-            int(x)
-        job_times = args.input
-    except ValueError:
+    pool_limits = {}
+    for pool_limit in args.pool_limit:
+        pool, _, n = pool_limit.partition("=")
+        if not n.isdigit():
+            parser.error(f"--pool-limit should be POOL=N, not {pool_limit}")
+        pool_limits[pool] = int(n)
+
+    if args.spec:
+        jobs = load_spec(args.spec)
+    elif not args.input:
+        parser.error("give job times, a repo slug, or --spec")
+    else:
+        # If all numbers
         try:
-            number = args.input[1]
-        except IndexError:
-            number = None
-        job_times = do_thing(args.input[0], number, args.com)
-
-    job_times = job_times[args.skip :]
-    print(job_times)
+            job_times = [float(x) if "." in x else int(x) for x in args.input]
+            jobs = [Job(job_time) for job_time in job_times]
+        except ValueError:
+            try:
+                number = args.input[1]
+            except IndexError:
+                number = None
+            history = None
+            if args.local:
+                history = BuildHistory(api=args.api)
+                if number is None:
+                    history.sync(args.input[0], since=-args.history)
+                    number = history.last_build(args.input[0])
+                else:
+                    history.sync(args.input[0], int(number) - args.history + 1)
+            jobs = get_jobs(args.input[0], number, args, history)
+            if args.history > 1:
+                if number is None:
+                    parser.error("--history needs a build number")
+                # Match up jobs by their position in each build
+                for past in range(int(number) - args.history + 1, int(number)):
+                    past_jobs = get_jobs(args.input[0], past, args, history)
+                    for job, past_job in zip(jobs, past_jobs):
+                        job.samples.append(past_job.length)
+
+    for i, job in enumerate(jobs, start=1):
+        job.id = i
+    jobs = jobs[args.skip :]
+    print([job.length for job in jobs])
+
+    explicit_needs = any(job.needs for job in jobs)
+    link_stages(jobs)
+
+    if args.sweep:
+        if explicit_needs or pool_limits:
+            parser.error("--sweep only supports stages, not needs or pool limits")
+        sweep(jobs, args.sweep)
+        sys.exit()
+
+    if args.monte_carlo:
+        if explicit_needs or pool_limits:
+            parser.error("--monte-carlo only supports stages, not needs or pool limits")
+        monte_carlo(
+            jobs,
+            args.limit,
+            args.monte_carlo,
+            args.seed,
+            args.strategy,
+            args.budget,
+        )
+        sys.exit()
 
     print("Before:")
     print()
 
-    jobs = []
-    for job_time in job_times:
-        job = Job(job_time)
-        jobs.append(job)
-
-    simulate(jobs, args.limit)
+    run(jobs, args.limit, pool_limits)
 
     print()
-    print("After:")
+    print(f"After ({'critical path' if explicit_needs else args.strategy}):")
     print()
 
-    # Sort with longest first
-    jobs.sort(key=lambda job: job.length, reverse=True)
-    # Reset status
-    for job in jobs:
-        job.status = "not started"
+    bound = max(
+        pools_bound(jobs, args.limit, pool_limits),
+        sum(job.length for job in critical_path(jobs)),
+    )
+    optimal = False
+    if explicit_needs:
+        jobs = critical_path_order(jobs)
+    else:
+        # Stages run one after the other, so order each one on its own
+        ordered = []
+        optimal = True
+        stage_bounds = 0
+        for stage in group_by(jobs, "stage"):
+            stage_bounds += pools_bound(stage, args.limit, pool_limits)
+            stage, stage_optimal = order_pools(
+                stage, args.limit, pool_limits, args.strategy, args.budget
+            )
+            optimal = optimal and stage_optimal
+            ordered.extend(stage)
+        jobs = ordered
+        bound = max(bound, stage_bounds)
+
+    schedule = run(jobs, args.limit, pool_limits)
+    end = schedule.makespan
 
-    simulate(jobs, args.limit)
+    print()
+    print("Lower bound:", format_minutes(bound))
+    optimal = optimal or end <= bound
+    print("Makespan:   ", format_minutes(end) + (" (optimal)" if optimal else ""))
+    print("Gap:        ", format_minutes(end - bound))
+    print(f"Utilisation: {schedule.utilization:.0%}")
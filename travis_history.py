@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+A local SQLite database of Travis CI build history, so history queries from
+time-travis-logs.py, travis-sorter.py and grep-travis-logs.py don't need to
+download the same builds every run.
+
+Each repo's builds and jobs are stored with their states, timestamps, durations,
+stages, OS and env. Finished builds don't change, so a sync only fetches builds
+newer than those already stored, and any which were still running. Each API
+endpoint gets its own database, as its build and job IDs are its own.
+
+Fetch new builds, or the latest hundred when there are none yet:
+
+$ travis_history.py sync python-pillow/Pillow --since -100
+
+Print stored builds:
+
+$ travis_history.py show python-pillow/Pillow --since 3900
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sqlite3
+import urllib.parse
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+from travis_log_store import DEFAULT_API, FINISHED_STATES, endpoint, get_json
+
+DEFAULT_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    / "ci-tools"
+    / "history"
+)
+PAGE_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    slug TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    event_type TEXT,
+    branch TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    duration INTEGER,
+    PRIMARY KEY (slug, number)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    build INTEGER NOT NULL,
+    number TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created_at TEXT,
+    started_at TEXT,
+    finished_at TEXT,
+    duration INTEGER,
+    stage TEXT,
+    os TEXT,
+    env TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_slug_build ON jobs (slug, build);
+"""
+
+
+class Build(NamedTuple):
+    number: int
+    id: int
+    state: str
+    event_type: str | None
+    branch: str | None
+    started_at: str | None
+    finished_at: str | None
+    # Total seconds of all its jobs
+    duration: int | None
+    job_ids: list[int]
+
+
+class BuildJob(NamedTuple):
+    id: int
+    build: int
+    number: str
+    state: str
+    created_at: str | None
+    started_at: str | None
+    finished_at: str | None
+    duration: int | None
+    stage: str | None
+    os: str | None
+    env: str | None
+
+
+def seconds_between(start, finish):
+    """Whole seconds between two ISO 8601 timestamps, or None if either is
+    missing"""
+    if not start or not finish:
+        return None
+    start = datetime.fromisoformat(start.replace("Z", "+00:00"))
+    finish = datetime.fromisoformat(finish.replace("Z", "+00:00"))
+    return round((finish - start).total_seconds())
+
+
+def job_env(config):
+    env = config.get("env")
+    if isinstance(env, list):
+        env = " ".join(str(item) for item in env)
+    elif isinstance(env, dict):
+        env = " ".join(f"{key}={value}" for key, value in env.items())
+    return env
+
+
+def default_path(api=DEFAULT_API):
+    return DEFAULT_DIR / f"{endpoint(api)}.sqlite3"
+
+
+class BuildHistory:
+    def __init__(self, path=None, api=DEFAULT_API):
+        self.api = api
+        path = path or default_path(api)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def last_build(self, slug):
+        """The newest build stored for a repo, or None"""
+        (build,) = self.connection.execute(
+            "SELECT MAX(number) FROM builds WHERE slug = ?", (slug,)
+        ).fetchone()
+        return build
+
+    def sync_from(self, slug):
+        """The oldest build which still needs fetching: the oldest stored while
+        running, or else the one after the newest stored, or None for none stored"""
+        (running,) = self.connection.execute(
+            "SELECT MIN(number) FROM builds WHERE slug = ? AND state NOT IN "
+            f"({', '.join('?' * len(FINISHED_STATES))})",
+            (slug, *FINISHED_STATES),
+        ).fetchone()
+        if running is not None:
+            return running
+        last = self.last_build(slug)
+        return None if last is None else last + 1
+
+    def sync(self, slug, since=None):
+        """Fetch and store the builds which still need fetching, newest first, a
+        page at a time. When none are stored yet, fetch back to build `since`, or
+        that many before the latest if negative, or all of them. When `since` is
+        older than the builds stored, fetch back to it. Returns how many builds
+        were stored."""
+        first = self.sync_from(slug)
+        (oldest,) = self.connection.execute(
+            "SELECT MIN(number) FROM builds WHERE slug = ?", (slug,)
+        ).fetchone()
+        if first is None or since is not None and 0 <= since < oldest:
+            first = since
+        url = (
+            f"{self.api}/repo/{urllib.parse.quote(slug, safe='')}/builds"
+            f"?limit={PAGE_SIZE}&include=build.jobs,job.config"
+        )
+        count = 0
+        while url:
+            page = get_json(url)
+            numbers = []
+            with self.connection:
+                for build in page["builds"]:
+                    number = int(build["number"])
+                    if first is not None and first < 0:
+                        # The first build is the newest, so count back from it
+                        first = max(0, number + first + 1)
+                    numbers.append(number)
+                    if first is None or number >= first:
+                        self._put(slug, build)
+                        count += 1
+            if first is not None and (not numbers or min(numbers) < first):
+                break
+            next_page = page["@pagination"]["next"]
+            url = next_page and self.api + next_page["@href"]
+        return count
+
+    def _put(self, slug, build):
+        number = int(build["number"])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                slug,
+                number,
+                build["id"],
+                build["state"],
+                build.get("event_type"),
+                (build.get("branch") or {}).get("name"),
+                build.get("started_at"),
+                build.get("finished_at"),
+                build.get("duration"),
+            ),
+        )
+        for job in build.get("jobs", []):
+            config = job.get("config") or {}
+            self.connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job["id"],
+                    slug,
+                    number,
+                    job.get("number"),
+                    job.get("state"),
+                    job.get("created_at"),
+                    job.get("started_at"),
+                    job.get("finished_at"),
+                    seconds_between(job.get("started_at"), job.get("finished_at")),
+                    (job.get("stage") or {}).get("name"),
+                    config.get("os"),
+                    job_env(config),
+                ),
+            )
+
+    def builds(self, slug, since=None, until=None):
+        """Stored builds from `since` up to `until`, oldest first"""
+        rows = self.connection.execute(
+            """
+            SELECT builds.number, builds.id, builds.state, event_type, branch,
+                builds.started_at, builds.finished_at, builds.duration, jobs.id
+            FROM builds LEFT JOIN jobs
+                ON builds.slug = jobs.slug AND builds.number = jobs.build
+            WHERE builds.slug = ? AND builds.number >= ? AND builds.number <= ?
+            ORDER BY builds.number, jobs.id
+            """,
+            (slug, since or 0, until or 2**62),
+        )
+        builds = []
+        for *fields, job_id in rows:
+            if not builds or builds[-1].number != fields[0]:
+                builds.append(Build(*fields, job_ids=[]))
+            if job_id is not None:
+                builds[-1].job_ids.append(job_id)
+        return builds
+
+    def jobs(self, slug, since=None, until=None):
+        """Stored jobs of builds from `since` up to `until`, in build and job
+        order"""
+        rows = self.connection.execute(
+            """
+            SELECT id, build, number, state, created_at, started_at, finished_at,
+                duration, stage, os, env
+            FROM jobs WHERE slug = ? AND build >= ? AND build <= ?
+            ORDER BY build, id
+            """,
+            (slug, since or 0, until or 2**62),
+        )
+        return [BuildJob(*row) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("command", choices=("sync", "show"))
+    parser.add_argument("slug", help="Repo slug")
+    parser.add_argument(
+        "--since",
+        type=int,
+        help="For sync, how far back to go when nothing is stored yet, negative "
+        "to count back from the latest build. For show, the first build to print",
+    )
+    parser.add_argument("--until", type=int, help="For show, the last build to print")
+    parser.add_argument("--api", default=DEFAULT_API, help="Travis CI API URL")
+    parser.add_argument(
+        "--path", help="Database file, instead of the default for the API"
+    )
+    args = parser.parse_args()
+
+    history = BuildHistory(args.path, args.api)
+    if args.command == "sync":
+        count = history.sync(args.slug, args.since)
+        print(f"Stored {count} builds of {args.slug}")
+    else:
+        for build in history.builds(args.slug, args.since, args.until):
+            duration = seconds_between(build.started_at, build.finished_at)
+            wall = (
+                "" if duration is None else f"{duration // 60:02}m{duration % 60:02}s"
+            )
+            print(f"{build.number}\t{build.state}\t{wall}\t{len(build.job_ids)} jobs")
+    history.close()
+
+
+if __name__ == "__main__":
+    main()
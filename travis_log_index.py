@@ -0,0 +1,269 @@
+"""
+A trigram index over the job logs kept in the local log store, so regex searches
+across many builds only scan the parts of logs that could match.
+
+Each log is split into blocks of lines, and each block gets a Bloom filter of the
+(lowercased) trigrams in it. A search works out which trigrams every match must
+contain from the literal parts of the regex, and only scans blocks whose filters
+have all of them. Indexing a new build just adds rows, so the index can be
+updated as builds arrive.
+"""
+
+from __future__ import annotations
+
+import re
+import sqlite3
+import zlib
+from pathlib import Path
+
+from travis_log_store import DEFAULT_API, DEFAULT_DIR, endpoint
+
+BLOCK_LINES = 1000
+# Bits in each block's Bloom filter, a power of two
+BLOOM_BITS = 1 << 16
+BLOOM_MASK = BLOOM_BITS - 1
+# A backslash and everything it escapes, such as \x41, \u00e9, \N{DASH} or \012
+ESCAPE = re.compile(
+    r"\\(?:x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}|[0-9]{1,3}|.)",
+    re.DOTALL,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    job_id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    build INTEGER NOT NULL,
+    job TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS logs_slug_build ON logs (slug, build);
+CREATE TABLE IF NOT EXISTS blocks (
+    job_id INTEGER NOT NULL,
+    first_line INTEGER NOT NULL,
+    bloom BLOB NOT NULL,
+    PRIMARY KEY (job_id, first_line)
+);
+CREATE TABLE IF NOT EXISTS pending (
+    job_id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    build INTEGER NOT NULL
+);
+"""
+
+
+def trigram_bits(trigram):
+    """The two Bloom filter bits for a trigram"""
+    h = zlib.crc32(trigram.encode("utf-8"))
+    return h & BLOOM_MASK, (h >> 16) & BLOOM_MASK
+
+
+def bloom_filter(lines):
+    bloom = bytearray(BLOOM_BITS // 8)
+    trigrams = set()
+    for line in lines:
+        line = line.lower()
+        trigrams.update(line[i : i + 3] for i in range(len(line) - 2))
+    for trigram in trigrams:
+        for bit in trigram_bits(trigram):
+            bloom[bit >> 3] |= 1 << (bit & 7)
+    return bytes(bloom)
+
+
+def literal_runs(pattern):
+    """Runs of literal characters which every match of the regex must contain.
+
+    Deliberately conservative: anything inside a group, anything made optional by
+    a quantifier, and any pattern with alternation is left out.
+    """
+    if "|" in pattern:
+        return []
+    runs = []
+    run = ""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            escape = ESCAPE.match(pattern, i)
+            escaped = escape[0][1:] if escape else ""
+            if len(escaped) == 1 and not escaped.isalnum() and depth == 0:
+                # Escaped punctuation is a literal
+                run += escaped
+            else:
+                # A class like \d, an anchor like \b, or a character given by
+                # its code, which is left out rather than decoded
+                runs.append(run)
+                run = ""
+            i += 1 + len(escaped) if escape else 2
+            continue
+        if c == "[":
+            # Skip the character class
+            i += 1
+            if pattern[i : i + 1] == "^":
+                i += 1
+            if pattern[i : i + 1] == "]":
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            runs.append(run)
+            run = ""
+        elif c in "*?{":
+            # The character before is optional, or repeated an unknown number
+            runs.append(run[:-1])
+            run = ""
+            if c == "{":
+                i = pattern.find("}", i)
+                if i == -1:
+                    break
+        elif c in ".^$+":
+            runs.append(run)
+            run = ""
+        elif c == "(":
+            runs.append(run)
+            run = ""
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif depth == 0:
+            run += c
+        i += 1
+    runs.append(run)
+    return [run for run in runs if len(run) >= 3]
+
+
+def required_trigrams(pattern):
+    trigrams = set()
+    for run in literal_runs(pattern):
+        run = run.lower()
+        trigrams.update(run[i : i + 3] for i in range(len(run) - 2))
+    return trigrams
+
+
+def query_mask(pattern):
+    """Bloom filter bits a block must have to possibly match, as an int"""
+    mask = 0
+    for trigram in required_trigrams(pattern):
+        for bit in trigram_bits(trigram):
+            mask |= 1 << bit
+    return mask
+
+
+def default_path(api=DEFAULT_API):
+    """Each API endpoint gets its own index, like the log store's job index"""
+    return DEFAULT_DIR / "index" / f"{endpoint(api)}.sqlite3"
+
+
+class LogIndex:
+    def __init__(self, path=None, api=DEFAULT_API):
+        path = path or default_path(api)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __contains__(self, job_id):
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM logs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def last_build(self, slug):
+        """The newest build indexed for a repo, or None"""
+        (build,) = self.connection.execute(
+            "SELECT MAX(build) FROM logs WHERE slug = ?", (slug,)
+        ).fetchone()
+        return build
+
+    def resume_from(self, slug):
+        """The oldest build with jobs left to index later, or else the one after
+        the newest indexed, or None for none indexed"""
+        (pending,) = self.connection.execute(
+            "SELECT MIN(build) FROM pending WHERE slug = ?", (slug,)
+        ).fetchone()
+        if pending is not None:
+            return pending
+        last = self.last_build(slug)
+        return None if last is None else last + 1
+
+    def defer(self, slug, build, job_id):
+        """Remember a job which was still running, to index it next time"""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO pending VALUES (?, ?, ?)", (job_id, slug, build)
+            )
+
+    def add(self, slug, build, job, job_id, lines):
+        """Index a log, reading its lines a block at a time"""
+        if job_id in self:
+            return
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO logs VALUES (?, ?, ?, ?)", (job_id, slug, build, job)
+            )
+            self.connection.execute("DELETE FROM pending WHERE job_id = ?", (job_id,))
+            block = []
+            first_line = 1
+            for line in lines:
+                block.append(line)
+                if len(block) == BLOCK_LINES:
+                    self._add_block(job_id, first_line, block)
+                    first_line += len(block)
+                    block = []
+            if block:
+                self._add_block(job_id, first_line, block)
+
+    def _add_block(self, job_id, first_line, lines):
+        self.connection.execute(
+            "INSERT INTO blocks VALUES (?, ?, ?)",
+            (job_id, first_line, bloom_filter(lines)),
+        )
+
+    def candidates(self, slug, patterns, since=None, until=None):
+        """Each indexed log which could match any of the patterns, with the first
+        line of each block in it which could match, in build and job order"""
+        masks = [query_mask(pattern) for pattern in patterns]
+        rows = self.connection.execute(
+            """
+            SELECT logs.job_id, build, job, first_line, bloom
+            FROM logs JOIN blocks ON logs.job_id = blocks.job_id
+            WHERE slug = ? AND build >= ? AND build <= ?
+            ORDER BY build, logs.job_id, first_line
+            """,
+            (slug, since or 0, until or 2**62),
+        )
+        current = None
+        for job_id, build, job, first_line, bloom in rows:
+            bits = int.from_bytes(bloom, "little")
+            if not any(bits & mask == mask for mask in masks):
+                continue
+            if current and current[0] != job_id:
+                yield current
+                current = None
+            if current is None:
+                current = (job_id, build, job, [])
+            current[3].append(first_line)
+        if current:
+            yield current
+
+    def search(self, store, slug, regex, patterns, since=None, until=None):
+        """Yield (build, job, line number, line) for each matching line, only
+        scanning the blocks which could match"""
+        for job_id, build, job, first_lines in self.candidates(
+            slug, patterns, since, until
+        ):
+            log = store.open(job_id)
+            if log is None:
+                # Evicted from the store since it was indexed
+                continue
+            blocks = set(first_lines)
+            last_line = first_lines[-1] + BLOCK_LINES - 1
+            with log:
+                for number, line in enumerate(log, start=1):
+                    if number > last_line:
+                        break
+                    first_line = number - (number - 1) % BLOCK_LINES
+                    if first_line in blocks and regex.search(line):
+                        yield build, job, number, line
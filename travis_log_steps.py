@@ -0,0 +1,107 @@
+"""
+Find how long each step of a Travis CI job took, from the travis_fold and
+travis_time markers in its log:
+
+travis_fold:start:install.1
+travis_time:start:0b2c4a10
+$ pip install -r requirements.txt
+...
+travis_time:end:0b2c4a10:start=1523456789000000000,finish=1523456801000000000,duration=12000000000,event=install
+travis_fold:end:install.1
+
+Used by grep-travis-logs.py and time-travis-logs.py.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import defaultdict
+from typing import NamedTuple
+
+FOLD = re.compile(r"travis_fold:(start|end):([\w.\-]+)")
+TIME_START = re.compile(r"travis_time:start:(\w+)")
+TIME_END = re.compile(
+    r"travis_time:end:(\w+):start=(\d+),finish=(\d+),duration=(\d+)(?:,event=(\w+))?"
+)
+MARKERS = re.compile(r"travis_(?:fold|time):\S*?(?=\r|\x1b|\s|$)")
+ANSI = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+
+class Step(NamedTuple):
+    name: str
+    command: str | None
+    # Nanoseconds since the epoch
+    start: int
+    finish: int
+
+    @property
+    def duration(self):
+        """In seconds"""
+        return (self.finish - self.start) / 1e9
+
+
+def step_name(event, folds, command):
+    """The phase from the marker if it's there, else the fold it's in without its
+    number (install.2 -> install), else the command itself"""
+    if event:
+        return event
+    if folds:
+        return re.sub(r"\.\d+$", "", folds[-1])
+    return command or "unknown"
+
+
+def parse_steps(lines):
+    """Read a log line by line, returning a Step for each timed command"""
+    steps = []
+    folds = []
+    command = None
+    for line in lines:
+        for match in FOLD.finditer(line):
+            action, name = match.groups()
+            if action == "start":
+                folds.append(name)
+            elif name in folds:
+                del folds[folds.index(name) :]
+
+        if TIME_START.search(line):
+            command = None
+
+        text = ANSI.sub("", MARKERS.sub("", line)).strip("\r\n")
+        text = text.rsplit("\r", 1)[-1].strip()
+        if command is None and text.startswith("$ "):
+            command = text[2:]
+
+        match = TIME_END.search(line)
+        if match:
+            _, start, finish, _, event = match.groups()
+            steps.append(
+                Step(step_name(event, folds, command), command, int(start), int(finish))
+            )
+            command = None
+    return steps
+
+
+def total_by_step(steps):
+    """Total seconds for each step name, in order of first appearance"""
+    totals = defaultdict(float)
+    for step in steps:
+        totals[step.name] += step.duration
+    return dict(totals)
+
+
+def add_totals(totals, more):
+    """Add one job's or build's totals into another's"""
+    for name, seconds in more.items():
+        totals[name] = totals.get(name, 0) + seconds
+    return totals
+
+
+def format_seconds(seconds):
+    m, s = divmod(round(seconds), 60)
+    return f"{m:02}m{s:02}s"
+
+
+def print_totals(totals):
+    """Print total time for each step, slowest first"""
+    for name, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+        print(f"{format_seconds(seconds)}\t{name}")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+A local store of Travis CI job logs, shared by grep-travis-logs.py and
+diff-travis-logs.py, so finished logs are only downloaded once.
+
+Logs are gzipped and stored by the SHA-256 of their contents, with a small index
+from job ID to hash, so identical logs are only stored once. When the logs take up
+more than the size limit, the least recently used ones are removed. Job IDs are
+only unique to each API endpoint, so the index is kept for each one.
+
+Print a job's log, fetching it on a miss:
+
+$ travis_log_store.py 361337420
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import urllib.parse
+from pathlib import Path
+
+DEFAULT_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "ci-tools" / "logs"
+)
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_API = "https://api.travis-ci.com"
+FINISHED_STATES = {"passed", "failed", "errored", "canceled"}
+CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for the API to respond, or to send more of a log
+TIMEOUT = 60
+# Idle keep-alive connections to keep, at least one for each thread fetching
+POOL_SIZE = 16
+
+
+def endpoint(api):
+    """A name for an API endpoint to keep its job IDs apart, as they're only unique
+    to each one, like api.travis-ci.com"""
+    return urllib.parse.urlsplit(api).netloc.replace(":", "_")
+
+
+class LogStore:
+    def __init__(
+        self, directory=DEFAULT_DIR, max_bytes=DEFAULT_MAX_BYTES, api=DEFAULT_API
+    ):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.api = api
+
+    def _object_path(self, digest):
+        return self.directory / "objects" / digest[:2] / f"{digest[2:]}.gz"
+
+    def _job_path(self, job_id):
+        return self.directory / "jobs" / endpoint(self.api) / str(job_id)
+
+    def path(self, job_id):
+        """Path to the gzipped log for a job, or None on a miss"""
+        try:
+            digest = self._job_path(job_id).read_text().strip()
+        except OSError:
+            return None
+        path = self._object_path(digest)
+        try:
+            # Keep recently used logs from being evicted
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def open(self, job_id):
+        """The log for a job as a text file to read line by line, or None on a
+        miss"""
+        path = self.path(job_id)
+        if path is None:
+            return None
+        try:
+            return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+        except OSError:
+            # Evicted by someone else since
+            return None
+
+    def get(self, job_id):
+        """The log for a job, or None on a miss"""
+        f = self.open(job_id)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, job_id, text):
+        self.put_file(job_id, io.BytesIO(text.encode("utf-8")))
+
+    def put_file(self, job_id, f):
+        """Store a log from a binary file, such as an HTTP response, a chunk at a
+        time"""
+        objects = self.directory / "objects"
+        objects.mkdir(parents=True, exist_ok=True)
+        sha256 = hashlib.sha256()
+        fd, temp = tempfile.mkstemp(dir=objects)
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            while chunk := f.read(CHUNK_SIZE):
+                sha256.update(chunk)
+                gz.write(chunk)
+
+        digest = sha256.hexdigest()
+        path = self._object_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(temp, path)
+        self._write(self._job_path(job_id), digest.encode())
+        self.evict()
+
+    def _write(self, path, data):
+        # Write somewhere else first, so other processes never see half a file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def evict(self):
+        """Remove the least recently used logs until the store fits its size"""
+        entries = []
+        for root, _, files in os.walk(self.directory / "objects"):
+            for name in files:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        # Index entries for evicted logs are left behind, and are just misses
+
+
+@functools.cache
+def session():
+    """One session shared by every thread, so requests reuse a pool of keep-alive
+    connections"""
+    # Slow to import
+    import requests  # pip install requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Travis-API-Version"] = "3"
+    return session
+
+
+def get_json(url):
+    response = session().get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def stream(url, headers=None):
+    """A response to read a chunk at a time from `response.raw`, which gives the
+    connection back to the pool once read to the end"""
+    response = session().get(url, headers=headers, stream=True, timeout=TIMEOUT)
+    response.raise_for_status()
+    # Undo any gzip from the server, as read() would
+    response.raw.decode_content = True
+    # Stay open at the end, for TextIOWrapper
+    response.raw.auto_close = False
+    return response
+
+
+def open_log(store, job_id, finished=None, api=DEFAULT_API):
+    """A job's log as a text file to read line by line, from the store, or else
+    streamed from the Travis CI API.
+
+    Logs of finished jobs are streamed into the store and read back from there. If
+    `finished` isn't known, ask the API. The store should be for the same API.
+    """
+    if store is not None:
+        f = store.open(job_id)
+        if f is not None:
+            return f
+
+    if finished is None:
+        finished = get_json(f"{api}/v3/job/{job_id}").get("state") in FINISHED_STATES
+    response = stream(f"{api}/v3/job/{job_id}/log.txt")
+    if store is not None and finished:
+        with response:
+            store.put_file(job_id, response.raw)
+        f = store.open(job_id)
+        if f is not None:
+            return f
+        # Too big for the store, fetch it again
+        response = stream(f"{api}/v3/job/{job_id}/log.txt")
+    return io.TextIOWrapper(response.raw, encoding="utf-8", errors="replace")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("job_id", help="Travis CI job ID")
+    parser.add_argument("--api", default=DEFAULT_API, help="Travis CI API URL")
+    parser.add_argument("--directory", default=DEFAULT_DIR, help="Store directory")
+    parser.add_argument(
+        "--max-mb",
+        type=int,
+        default=DEFAULT_MAX_BYTES // 1024 // 1024,
+        help="Size limit for the store, in MiB",
+    )
+    args = parser.parse_args()
+
+    store = LogStore(args.directory, args.max_mb * 1024 * 1024, args.api)
+    with open_log(store, args.job_id, api=args.api) as f:
+        shutil.copyfileobj(f, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+"""
+Simulate and optimise the order of CI build jobs, which run with a limited number
+of concurrent slots.
+
+Used by travis-sorter.py, and importable on its own:
+
+>>> from travis_scheduler import Job, lpt_order, simulate
+>>> jobs = [Job(4), Job(4), Job(12)]
+>>> simulate(jobs, limit=2).makespan
+16.0
+>>> lengths = [job.length for job in jobs]
+>>> simulate([jobs[i] for i in lpt_order(lengths, 2)], limit=2).makespan
+12.0
+
+Lengths can be in any unit, travis-sorter.py uses minutes.
+"""
+
+from __future__ import annotations
+
+import collections
+import heapq
+import sys
+import time
+from array import array
+
+# Job states
+NOT_STARTED = 0
+ACTIVE = 1
+FINISHED = 2
+
+
+class Job:
+    __slots__ = ("id", "length", "name", "stage", "pool", "needs", "samples")
+
+    def __init__(self, length, id=None, name=None, stage=None, needs=(), pool=None):
+        self.id = id
+        self.length = length
+        self.name = name
+        self.stage = stage
+        # Jobs which must finish before this one can start
+        self.needs = list(needs)
+        # Runner pool, such as the OS, which may have its own concurrency limit
+        self.pool = pool
+        # Lengths from past builds, for Monte Carlo simulations
+        self.samples = [length]
+
+    def __repr__(self):
+        return f"Job({self.length!r}, id={self.id!r})"
+
+
+class Schedule:
+    """When each job starts and ends, with the jobs in the order they were given"""
+
+    __slots__ = ("jobs", "limit", "starts", "ends", "states")
+
+    def __init__(self, jobs, limit):
+        self.jobs = jobs
+        self.limit = limit
+        self.starts = array("d", [0]) * len(jobs)
+        self.ends = array("d", [0]) * len(jobs)
+        self.states = array("b", [NOT_STARTED]) * len(jobs)
+
+    @property
+    def makespan(self):
+        return max(self.ends, default=0)
+
+    @property
+    def utilization(self):
+        """How much of the available slot time the jobs used"""
+        if not self.makespan:
+            return 0
+        slots = min(self.limit, len(self.jobs))
+        return sum(self.ends[i] - self.starts[i] for i in range(len(self.jobs))) / (
+            slots * self.makespan
+        )
+
+    def __iter__(self):
+        """Each job with its start and end time"""
+        return zip(self.jobs, self.starts, self.ends)
+
+
+def simulate(jobs, limit, pool_limits=None):
+    """Start each job in order as soon as one of the `limit` slots is free and
+    everything it needs has finished.
+
+    Rather than ticking minute by minute, keep a min-heap of the end times of the
+    running jobs and jump straight to the next one to finish. Jobs whose needs are
+    met wait in a heap per pool, keyed by their position in the order. That's
+    O(n log n) and exact for fractional (second-level) durations.
+
+    `pool_limits` caps how many jobs of each pool can run at once, on top of the
+    overall `limit`.
+
+    Returns a Schedule, and leaves the jobs untouched.
+    """
+    pool_limits = pool_limits or {}
+    result = Schedule(jobs, limit)
+    starts, ends, states = result.starts, result.ends, result.states
+    position = {job: i for i, job in enumerate(jobs)}
+    dependants = [[] for _ in jobs]
+    waiting = array("l", [0]) * len(jobs)
+    for i, job in enumerate(jobs):
+        for need in job.needs:
+            if need in position:
+                waiting[i] += 1
+                dependants[position[need]].append(i)
+
+    ready = {job.pool: [] for job in jobs}
+    active = dict.fromkeys(ready, 0)
+    for i, job in enumerate(jobs):
+        if not waiting[i]:
+            ready[job.pool].append(i)
+    running = []
+    now = 0
+    scheduled = 0
+
+    while running or any(ready.values()):
+        while len(running) < limit:
+            # The first ready job in the order whose pool has a free slot
+            pools = [
+                pool
+                for pool, heap in ready.items()
+                if heap and active[pool] < pool_limits.get(pool, limit)
+            ]
+            if not pools:
+                break
+            pool = min(pools, key=lambda pool: ready[pool][0])
+            i = heapq.heappop(ready[pool])
+            active[pool] += 1
+            starts[i] = now
+            ends[i] = now + jobs[i].length
+            states[i] = ACTIVE
+            heapq.heappush(running, (ends[i], i))
+            scheduled += 1
+
+        if not running:
+            # Nothing can start: a pool has a limit of zero
+            break
+
+        # Jump to the next job to finish, along with any others ending then
+        now = running[0][0]
+        while running and running[0][0] == now:
+            _, i = heapq.heappop(running)
+            states[i] = FINISHED
+            active[jobs[i].pool] -= 1
+            for dependant in dependants[i]:
+                waiting[dependant] -= 1
+                if not waiting[dependant]:
+                    heapq.heappush(ready[jobs[dependant].pool], dependant)
+
+    if scheduled < len(jobs):
+        msg = "Job dependencies form a cycle, or a pool has no slots"
+        raise ValueError(msg)
+
+    return result
+
+
+def lower_bound(lengths, limit):
+    """No order can finish before the longest job, or before the total work is
+    spread evenly over all the slots"""
+    if not lengths:
+        return 0
+    return max(max(lengths), sum(lengths) / limit)
+
+
+def order_from_bins(bins, lengths):
+    """Turn an assignment of jobs to slots into a start order.
+
+    Each slot runs its jobs back to back, so sort all jobs by their start time
+    within their slot. Starting jobs in this order never finishes later than the
+    assignment itself.
+    """
+    starts = []
+    for slot in bins:
+        time = 0
+        for i in sorted(slot, key=lambda i: lengths[i], reverse=True):
+            starts.append((time, -lengths[i], i))
+            time += lengths[i]
+    return [i for _, _, i in sorted(starts)]
+
+
+def first_fit_decreasing(lengths, capacity, limit):
+    """Pack jobs longest first into at most `limit` bins of `capacity`,
+    or return None if they don't fit"""
+    bins = []
+    loads = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        for b, load in enumerate(loads):
+            if load + lengths[i] <= capacity:
+                bins[b].append(i)
+                loads[b] += lengths[i]
+                break
+        else:
+            if len(bins) == limit:
+                return None
+            bins.append([i])
+            loads.append(lengths[i])
+    return bins
+
+
+def lpt_order(lengths, limit):
+    """Longest processing time first"""
+    return sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+
+def multifit_order(lengths, limit, iterations=10, tolerance=0.001):
+    """MULTIFIT: binary search for the smallest bin size that first-fit decreasing
+    can pack into `limit` bins, starting from the LPT makespan.
+
+    Stops once the bin size is within `tolerance` of the lower bound, as a
+    fraction of it, so it works the same whatever unit the lengths are in.
+    """
+    best = lpt_order(lengths, limit)
+    low = lower_bound(lengths, limit)
+    high = order_makespan(lengths, best, limit)
+
+    for _ in range(iterations):
+        if high - low <= tolerance * low:
+            break
+        capacity = (low + high) / 2
+        bins = first_fit_decreasing(lengths, capacity, limit)
+        if bins is None:
+            low = capacity
+            continue
+        high = capacity
+        order = order_from_bins(bins, lengths)
+        if order_makespan(lengths, order, limit) < order_makespan(lengths, best, limit):
+            best = order
+
+    return best
+
+
+def exact_order(lengths, limit, budget=10):
+    """Branch and bound over assignments of jobs to slots, starting from the
+    MULTIFIT solution. Stops early if it matches the lower bound or runs out of
+    its time `budget` in seconds.
+
+    Returns the order, and whether it's proven optimal.
+    """
+    best_order = multifit_order(lengths, limit)
+    best = order_makespan(lengths, best_order, limit)
+    bound = lower_bound(lengths, limit)
+    if best <= bound or len(lengths) <= limit:
+        return best_order, True
+
+    deadline = time.monotonic() + budget
+    jobs = lpt_order(lengths, limit)
+    loads = [0] * limit
+    bins = [[] for _ in range(limit)]
+    best_bins = None
+    timed_out = False
+
+    def branch(depth, current):
+        nonlocal best, best_bins, timed_out
+        if timed_out or best <= bound:
+            return
+        if time.monotonic() > deadline:
+            timed_out = True
+            return
+        if depth == len(jobs):
+            best = current
+            best_bins = [slot[:] for slot in bins]
+            return
+        i = jobs[depth]
+        # Can't beat the best if even the least loaded slot is too full for the
+        # next job
+        if min(loads) + lengths[i] >= best:
+            return
+
+        tried = set()
+        for slot in sorted(range(limit), key=loads.__getitem__):
+            # Slots with the same load are interchangeable
+            if loads[slot] in tried:
+                continue
+            tried.add(loads[slot])
+            load = loads[slot] + lengths[i]
+            if load >= best:
+                continue
+            loads[slot] = load
+            bins[slot].append(i)
+            branch(depth + 1, max(current, load))
+            bins[slot].pop()
+            loads[slot] -= lengths[i]
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), len(jobs) + 100))
+    branch(0, 0)
+
+    if best_bins is not None:
+        order = order_from_bins(best_bins, lengths)
+        if order_makespan(lengths, order, limit) < order_makespan(
+            lengths, best_order, limit
+        ):
+            best_order = order
+    return best_order, not timed_out
+
+
+def start_times(lengths, order, limit):
+    """Start time of each job in this order, without keeping a schedule"""
+    running = []
+    starts = []
+    for i in order:
+        start = heapq.heappop(running) if len(running) >= limit else 0
+        heapq.heappush(running, start + lengths[i])
+        starts.append(start)
+    return starts
+
+
+def order_makespan(lengths, order, limit):
+    """End time of starting jobs in this order, without keeping a schedule"""
+    return max(
+        (
+            start + lengths[i]
+            for start, i in zip(start_times(lengths, order, limit), order)
+        ),
+        default=0,
+    )
+
+
+def order_jobs(jobs, limit, strategy, budget):
+    """Order independent jobs with a strategy.
+
+    Returns the jobs, and whether the order is proven optimal.
+    """
+    lengths = [job.length for job in jobs]
+    optimal = False
+    if strategy == "exact":
+        order, optimal = exact_order(lengths, limit, budget)
+    elif strategy == "multifit":
+        order = multifit_order(lengths, limit)
+    else:
+        # Sort with longest first
+        order = lpt_order(lengths, limit)
+    return [jobs[i] for i in order], optimal
+
+
+def get_pool_limit(pool, limit, pool_limits):
+    return min(limit, pool_limits.get(pool, limit))
+
+
+def pools_bound(jobs, limit, pool_limits):
+    """Lower bound for independent jobs, where each pool must also fit in its own
+    slots"""
+    bound = lower_bound([job.length for job in jobs], limit)
+    for pool in group_by(jobs, "pool"):
+        pool_limit = get_pool_limit(pool[0].pool, limit, pool_limits)
+        bound = max(bound, lower_bound([job.length for job in pool], pool_limit))
+    return bound
+
+
+def merge_bottleneck_first(pools, limits, limit):
+    """Merge the ordered pools by simulating them together, always starting the
+    next job from the pool with the most work left per slot"""
+    queues = [collections.deque(pool) for pool in pools]
+    remaining = [sum(job.length for job in pool) for pool in pools]
+    active = [0] * len(pools)
+    running = []
+    order = []
+    now = 0
+
+    while any(queues):
+        while len(running) < limit:
+            eligible = [
+                p for p, queue in enumerate(queues) if queue and active[p] < limits[p]
+            ]
+            if not eligible:
+                break
+            p = max(eligible, key=lambda p: remaining[p] / limits[p])
+            job = queues[p].popleft()
+            remaining[p] -= job.length
+            active[p] += 1
+            order.append(job)
+            heapq.heappush(running, (now + job.length, len(order), p))
+        if not running:
+            # A pool has no slots, leave the rest for simulate() to reject
+            break
+        now, _, p = heapq.heappop(running)
+        active[p] -= 1
+
+    for queue in queues:
+        order.extend(queue)
+    return order
+
+
+def order_pools(jobs, limit, pool_limits, strategy, budget):
+    """Order independent jobs from several pools.
+
+    Order each pool on its own within its slots, then merge the pools. Either merge
+    by when each job would start with its pool to itself, with ties going to the
+    bottleneck pool, the one with the most work per slot. Or when the overall limit
+    is tight, keep starting jobs from whichever pool has the most work left per
+    slot. Keep whichever merge finishes first.
+
+    Returns the jobs, and whether the order is proven optimal.
+    """
+    pools = group_by(jobs, "pool")
+    limits = [get_pool_limit(pool[0].pool, limit, pool_limits) for pool in pools]
+    # Each pool is only independent of the others if they all fit together
+    optimal = sum(limits) <= limit or len(pools) == 1
+    ordered_pools = []
+    planned = []
+    for pool, pool_limit in zip(pools, limits):
+        ordered, pool_optimal = order_jobs(pool, pool_limit, strategy, budget)
+        optimal = optimal and pool_optimal
+        ordered_pools.append(ordered)
+        lengths = [job.length for job in ordered]
+        bound = lower_bound(lengths, pool_limit)
+        starts = start_times(lengths, range(len(ordered)), pool_limit)
+        for start, job in zip(starts, ordered):
+            planned.append((start, -bound, len(planned), job))
+    planned.sort(key=lambda plan: plan[:3])
+    best = [plan[3] for plan in planned]
+
+    if len(pools) > 1 and not optimal:
+        merged = merge_bottleneck_first(ordered_pools, limits, limit)
+        if (
+            simulate(merged, limit, pool_limits).makespan
+            < simulate(best, limit, pool_limits).makespan
+        ):
+            best = merged
+
+    return best, optimal
+
+
+def link_stages(jobs):
+    """Each job in a stage needs every job in the stage before it"""
+    stages = group_by(jobs, "stage")
+    for previous, stage in zip(stages, stages[1:]):
+        for job in stage:
+            job.needs.extend(need for need in previous if need not in job.needs)
+
+
+def group_by(jobs, attribute):
+    """Jobs grouped by stage or pool, in order of first appearance"""
+    groups = {}
+    for job in jobs:
+        groups.setdefault(getattr(job, attribute), []).append(job)
+    return list(groups.values())
+
+
+def bottom_levels(jobs):
+    """The longest path from the start of each job to the end of the build"""
+    dependants = {job: [] for job in jobs}
+    for job in jobs:
+        for need in job.needs:
+            if need in dependants:
+                dependants[need].append(job)
+
+    levels = {}
+
+    def level(job):
+        if job not in levels:
+            levels[job] = job.length + max(
+                (level(dependant) for dependant in dependants[job]), default=0
+            )
+        return levels[job]
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), len(jobs) + 100))
+    for job in jobs:
+        level(job)
+    return levels, dependants
+
+
+def critical_path(jobs):
+    """The chain of jobs which takes longest, even with unlimited slots"""
+    levels, dependants = bottom_levels(jobs)
+    if not jobs:
+        return []
+    roots = [job for job in jobs if not any(need in levels for need in job.needs)]
+    path = [max(roots, key=levels.__getitem__)]
+    while dependants[path[-1]]:
+        path.append(max(dependants[path[-1]], key=levels.__getitem__))
+    return path
+
+
+def critical_path_order(jobs):
+    """Start the jobs with the longest path to the end of the build first"""
+    levels, _ = bottom_levels(jobs)
+    return sorted(jobs, key=lambda job: (levels[job], job.length), reverse=True)
+
+
+def sweep_makespans(lengths, limits):
+    """End time of starting jobs in order, for every limit at once.
+
+    Each row holds when the slots for one limit are next free, with the slots
+    beyond that limit never free. Each job then goes to the earliest free slot of
+    every row in one vectorised step, rather than one simulation per limit.
+    """
+    import numpy as np  # pip install numpy
+
+    limits = np.asarray(limits)
+    free = np.where(np.arange(limits.max()) < limits[:, None], 0.0, np.inf)
+    rows = np.arange(len(limits))
+    for length in lengths:
+        free[rows, free.argmin(axis=1)] += length
+    return np.where(np.isinf(free), 0, free).max(axis=1)
+
+
+def find_knee(limits, makespans):
+    """The limit after which more slots stop paying off: the point of the curve
+    furthest below the straight line from its first to its last point"""
+    import numpy as np  # pip install numpy
+
+    x = np.asarray(limits, dtype=float)
+    y = np.asarray(makespans, dtype=float)
+    if x[-1] == x[0] or y[0] == y[-1]:
+        return limits[0]
+    x = (x - x[0]) / (x[-1] - x[0])
+    y = (y - y[-1]) / (y[0] - y[-1])
+    return limits[int(np.argmax((1 - x) - y))]
+
+
+def draw_lengths(jobs, simulations, rng):
+    """Bootstrap a length for each job in each simulation from its past lengths.
+
+    Returns an array of shape (simulations, jobs).
+    """
+    import numpy as np  # pip install numpy
+
+    return np.column_stack([rng.choice(job.samples, simulations) for job in jobs])
+
+
+def monte_carlo_makespans(lengths, limit):
+    """End time of starting jobs in order, for each row of lengths at once.
+
+    Like sweep_makespans(), but with one row per simulation rather than per limit.
+    """
+    import numpy as np  # pip install numpy
+
+    simulations, n = lengths.shape
+    free = np.zeros((simulations, max(1, min(limit, n))))
+    rows = np.arange(simulations)
+    for column in lengths.T:
+        free[rows, free.argmin(axis=1)] += column
+    return free.max(axis=1)